@@ -0,0 +1,84 @@
+"""
+Benchmark memory per series and rendering time of a labelled prometheus_client Gauge
+against the UserGroupGauge collector.
+
+Run with `python benchmarks/bench_collector_memory.py` with the package installed.
+"""
+
+import gc
+import time
+import tracemalloc
+
+from prometheus_client import CollectorRegistry, Gauge, generate_latest
+
+from jupyterhub_groups_exporter.metrics import USER_LABELNAMES, UserGroupGauge
+
+N_SERIES = 100_000
+
+
+def synthetic_samples(n_series: int) -> dict:
+    return {
+        (
+            "hub",
+            f"group-{i % 50}",
+            f"user-{i}",
+            f"user-2d{i}",
+            f"user-{i}",
+        ): float(i)
+        for i in range(n_series)
+    }
+
+
+def fill_prometheus_client_gauge(registry: CollectorRegistry, samples: dict):
+    gauge = Gauge(
+        "user_group_memory_bytes", "Test.", USER_LABELNAMES, registry=registry
+    )
+    for labelvalues, value in samples.items():
+        gauge.labels(*labelvalues).set(value)
+    return gauge
+
+
+def fill_user_group_gauge(registry: CollectorRegistry, samples: dict):
+    gauge = UserGroupGauge(
+        "user_group_memory_bytes",
+        "Test.",
+        USER_LABELNAMES,
+        namespace="jupyterhub",
+        registry=registry,
+    )
+    gauge.set_samples(samples)
+    return gauge
+
+
+def measure(fill: callable):
+    registry = CollectorRegistry()
+    samples = synthetic_samples(N_SERIES)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    gauge = fill(registry, samples)
+    # Drop the input samples, keeping only the memory held by the gauge
+    del samples
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    generate_latest(registry)
+    render = time.perf_counter() - start
+    del gauge
+    return (after - before) / N_SERIES, render
+
+
+def main():
+    print(f"{N_SERIES} series")
+    print(f"{'collector':>24} {'bytes/series':>13} {'render (ms)':>12}")
+    for name, fill in [
+        ("prometheus_client Gauge", fill_prometheus_client_gauge),
+        ("UserGroupGauge", fill_user_group_gauge),
+    ]:
+        per_series, render = measure(fill)
+        print(f"{name:>24} {per_series:>13.0f} {render * 1e3:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
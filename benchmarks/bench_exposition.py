@@ -0,0 +1,60 @@
+"""
+Benchmark rendering time and size of the metrics exposition in each format and
+compression, for the six usage gauges labelled by user.
+
+Run with `python benchmarks/bench_exposition.py` with the package installed.
+"""
+
+import timeit
+
+from prometheus_client import CollectorRegistry
+
+from jupyterhub_groups_exporter.exposition import COMPRESSORS, FORMATS, Exposition
+from jupyterhub_groups_exporter.metrics import (
+    USER_GAUGES,
+    USER_LABELNAMES,
+    UserGroupGauge,
+)
+
+N_USERS = 20_000
+
+
+def synthetic_registry(n_users: int) -> CollectorRegistry:
+    registry = CollectorRegistry()
+    samples = {
+        (
+            "hub",
+            f"group-{i % 50}",
+            f"user-{i}",
+            f"user-2d{i}",
+            f"user-{i}",
+        ): float(i)
+        for i in range(n_users)
+    }
+    for name in USER_GAUGES:
+        gauge = UserGroupGauge(
+            name, "Test.", USER_LABELNAMES, namespace="jupyterhub", registry=registry
+        )
+        gauge.set_samples(samples)
+    return registry
+
+
+def main():
+    registry = synthetic_registry(N_USERS)
+    print(f"{N_USERS} users, {len(USER_GAUGES)} gauges")
+    print(f"{'format':>12} {'encoding':>9} {'size (kB)':>10} {'time (ms)':>10}")
+    for fmt in FORMATS:
+        for encoding in ["identity", *COMPRESSORS]:
+            elapsed = min(
+                timeit.repeat(
+                    lambda: Exposition(registry).render(fmt, encoding),
+                    number=1,
+                    repeat=3,
+                )
+            )
+            size = len(Exposition(registry).render(fmt, encoding))
+            print(f"{fmt:>12} {encoding:>9} {size / 1e3:>10.0f} {elapsed * 1e3:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Benchmark decode time and peak memory of Prometheus and JupyterHub API responses with the
+stdlib json decoder against orjson.
+
+Run with `python benchmarks/bench_json_decode.py` with the package and orjson installed.
+The peak is the memory allocated while decoding one response, on top of its body.
+"""
+
+import json
+import timeit
+import tracemalloc
+
+from jupyterhub_groups_exporter.groups_exporter import hub_loads, prometheus_loads
+
+N_USERS = 100_000
+
+
+def synthetic_prometheus_response(n_users: int, n_values: int) -> str:
+    if n_values == 1:
+        results = [
+            {
+                "metric": {"namespace": "hub", "username": f"user-{i}"},
+                "value": [1700000000.0, f"{i * 1.5}"],
+            }
+            for i in range(n_users)
+        ]
+    else:
+        results = [
+            {
+                "metric": {"namespace": "hub", "username": f"user-{i}"},
+                "values": [[1700000000.0 + t, f"{i * 1.5}"] for t in range(n_values)],
+            }
+            for i in range(n_users)
+        ]
+    return json.dumps({"status": "success", "data": {"result": results}})
+
+
+def synthetic_hub_response(n_users: int) -> str:
+    items = [
+        {
+            "kind": "user",
+            "name": f"user-{i}",
+            "admin": False,
+            "groups": [f"group-{i % 50}"],
+            "server": None,
+            "last_activity": "2024-01-01T00:00:00.000000Z",
+            "roles": ["user"],
+        }
+        for i in range(n_users)
+    ]
+    return json.dumps(
+        {
+            "items": items,
+            "_pagination": {"offset": 0, "limit": n_users, "total": n_users},
+        }
+    )
+
+
+def measure(loads: callable, body: str):
+    elapsed = min(timeit.repeat(lambda: loads(body), number=1, repeat=5))
+    tracemalloc.start()
+    data = loads(body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del data
+    return elapsed, peak
+
+
+def main():
+    responses = [
+        ("prometheus instant", synthetic_prometheus_response(N_USERS, 1), "last"),
+        ("prometheus range", synthetic_prometheus_response(N_USERS, 10), "avg"),
+        ("hub users", synthetic_hub_response(N_USERS), None),
+    ]
+    print(
+        f"{'response':>20} {'decoder':>8} {'MB':>6} {'time (ms)':>10} {'peak (MB)':>10}"
+    )
+    for name, body, usage_aggregation in responses:
+        for decoder in ["json", "orjson"]:
+            if usage_aggregation is None:
+                loads = hub_loads(decoder)
+            else:
+                loads = prometheus_loads(decoder, usage_aggregation)
+            elapsed, peak = measure(loads, body)
+            print(
+                f"{name:>20} {decoder:>8} {len(body) / 1e6:>6.1f} "
+                f"{elapsed * 1e3:>10.1f} {peak / 1e6:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
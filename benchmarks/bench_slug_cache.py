@@ -0,0 +1,52 @@
+"""
+Micro-benchmark for escaping usernames with and without the slug cache.
+
+Run with `python benchmarks/bench_slug_cache.py` with the package installed.
+A cycle escapes every username once for each of the six exported metrics.
+"""
+
+import timeit
+
+from jupyterhub_groups_exporter.groups_exporter import (
+    SlugCache,
+    _escape_username,
+    _escape_username_safe,
+)
+
+N_METRICS = 6
+
+
+def uncached_cycle(usernames: list):
+    for _ in range(N_METRICS):
+        for username in usernames:
+            _escape_username(username)
+            _escape_username_safe(username)
+
+
+def cached_cycle(cache: SlugCache, usernames: list):
+    for _ in range(N_METRICS):
+        for username in usernames:
+            cache.get(username)
+
+
+def main():
+    print(f"{'users':>8} {'uncached (ms)':>14} {'cached (ms)':>12} {'hit rate':>9}")
+    for n_users in [1_000, 10_000]:
+        usernames = [f"User.{i}@example.org" for i in range(n_users)]
+        uncached = min(
+            timeit.repeat(lambda: uncached_cycle(usernames), number=1, repeat=3)
+        )
+        cache = SlugCache(maxsize=n_users)
+        # The first cycle fills the cache, later cycles only hit it
+        cached_cycle(cache, usernames)
+        cached = min(
+            timeit.repeat(lambda: cached_cycle(cache, usernames), number=1, repeat=3)
+        )
+        hit_rate = cache.hits / (cache.hits + cache.misses)
+        print(
+            f"{n_users:>8} {uncached * 1e3:>14.1f} {cached * 1e3:>12.1f} {hit_rate:>9.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+Micro-benchmark for joining users with their group memberships.
+
+Run with `python benchmarks/bench_user_group_join.py` with the package installed.
+The time per user should stay roughly constant as the number of users grows.
+"""
+
+import random
+import timeit
+
+from jupyterhub_groups_exporter.groups_exporter import join_user_groups
+
+N_GROUPS = 50
+
+
+def synthetic_user_index(n_users: int) -> dict:
+    rng = random.Random(n_users)
+    groups = [f"group-{i}" for i in range(N_GROUPS)]
+    return {
+        f"user-{i}": tuple(rng.sample(groups, rng.choice([0, 1, 1, 1, 2, 3])))
+        for i in range(n_users)
+    }
+
+
+def main():
+    allowed_groups = frozenset(f"group-{i}" for i in range(0, N_GROUPS, 2))
+    print(f"{'users':>8} {'total (ms)':>12} {'per user (us)':>14}")
+    for n_users in [1_000, 10_000, 100_000]:
+        user_index = synthetic_user_index(n_users)
+        n_runs = 5
+        elapsed = min(
+            timeit.repeat(
+                lambda: join_user_groups(user_index, allowed_groups),
+                number=1,
+                repeat=n_runs,
+            )
+        )
+        print(f"{n_users:>8} {elapsed * 1e3:>12.2f} {elapsed / n_users * 1e6:>14.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -32,9 +32,14 @@ c.JupyterHub.cleanup_servers = True
 c.JupyterHub.load_roles = [
     {
         "name": "groups-exporter",
+        # Only grant the scopes needed to read usernames and group memberships,
+        # so that the Hub trims the user and group models it returns.
         "scopes": [
-            "users",
-            "groups",
+            "list:users",
+            "read:users:name",
+            "read:users:groups",
+            "list:groups",
+            "read:groups:name",
         ],
         "services": ["groups-exporter"],
     },
@@ -4,18 +4,54 @@ Application backend to fetch user group memberships from the JupyterHub API and
 
 import argparse
 import asyncio
+import hmac
 import logging
 import os
+import sqlite3
+import time
 
-import aiohttp
 from aiohttp import web
-from prometheus_client import (
-    generate_latest,
-)
 from yarl import URL
 
-from .groups_exporter import update_group_usage, update_user_group_info
-from .metrics import CONFIG_COMPUTE, CONFIG_DIRSIZE
+from .debug import add_debug_routes
+from .executor import EXECUTOR_KINDS, make_executor, run_blocking
+from .exposition import (
+    FORMATS,
+    PRERENDERED,
+    Exposition,
+    negotiate_encoding,
+    negotiate_format,
+)
+from .groups_exporter import (
+    JSON_DECODERS,
+    SLUG_CACHE,
+    apply_membership_events,
+    current_update,
+    orjson,
+    parse_membership_events,
+    save_user_group_snapshot,
+    set_user_group_info,
+    update_group_usage,
+    update_user_group_info,
+)
+from .metrics import (
+    CONFIG_COMPUTE,
+    CONFIG_DIRSIZE,
+    EVENT_LOOP_LAG,
+    UPDATE_DEADLINE_EXCEEDED,
+    UPDATE_DURATION,
+    UPDATE_ERRORS,
+    UPDATE_ITEMS,
+    UPDATE_LAST_SUCCESS,
+    USER_GAUGES,
+    USERNAME_LABELS,
+    set_username_labels,
+)
+from .resilience import CircuitBreaker, RetryBudget, UpstreamPolicy
+from .scheduler import Scheduler, run_deadline
+from .sessions import make_session
+from .shared_state import SharedState
+from .snapshot import decode_snapshot, load_snapshot
 
 logger = logging.getLogger(__name__)
 
@@ -27,51 +63,371 @@ def _str_to_bool(value: str) -> bool:
         return False
 
 
+def _parse_username_labels(value: str) -> tuple[str, list]:
+    """
+    Parse a METRIC=LABEL,LABEL option into the metric name and its username labels.
+    """
+    metric, _, labels = value.partition("=")
+    labels = [label for label in labels.split(",") if label]
+    if metric not in USER_GAUGES:
+        raise argparse.ArgumentTypeError(
+            f"Unknown metric {metric!r}, choose from {list(USER_GAUGES)}."
+        )
+    if not labels or not set(labels) <= set(USERNAME_LABELS):
+        raise argparse.ArgumentTypeError(
+            f"Username labels of {metric} must be one or more of {USERNAME_LABELS}."
+        )
+    return metric, labels
+
+
+def render_metrics(app: web.Application):
+    """
+    Render the metrics exposition of this cycle and store it for handle to serve.
+
+    The gzipped text and OpenMetrics formats, and every format and compression negotiated
+    by a scraper before, are rendered right away, and any others the first time a scraper
+    asks for them. The payload is replaced with a single assignment, so a scrape always
+    sees either the previous or the new payload in full.
+    """
+    exposition = Exposition()
+    for fmt, encoding in {*PRERENDERED, *app["exposition"]["negotiated"]}:
+        exposition.render(fmt, encoding)
+    app["exposition"]["payload"] = exposition
+
+
 async def handle(request: web.Request):
-    return web.Response(
-        body=generate_latest(),
-        status=200,
-        content_type="text/plain",
-    )
+    """
+    Serve the metrics in the format and compression negotiated with the scraper from its
+    Accept and Accept-Encoding headers.
+    """
+    exposition = request.app["exposition"]["payload"]
+    fmt = negotiate_format(request.headers.get("Accept", ""), exposition.formats)
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding", ""))
+    body = exposition.get(fmt, encoding)
+    if body is None:
+        body = await run_blocking(request.app, exposition.render, fmt, encoding)
+        # Render it with the next cycles too, before this scraper asks for it again
+        request.app["exposition"]["negotiated"].add((fmt, encoding))
+    content_type, _ = FORMATS[fmt]
+    headers = {"Content-Type": content_type, "Vary": "Accept, Accept-Encoding"}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return web.Response(body=body, status=200, headers=headers)
 
 
-async def background_update(
-    app: web.Application, config: dict, update_function: callable
-):
-    while True:
+async def handle_membership_events(request: web.Request):
+    """
+    Apply group membership events posted by a JupyterHub hook to user_group_info right away.
+    """
+    app = request.app
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(
+        authorization.encode(), f"token {app['membership_events_token']}".encode()
+    ):
+        raise web.HTTPForbidden(text="Invalid membership events token.")
+    try:
+        events = parse_membership_events(await request.json())
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    state = app["shared_state"]
+    if state is not None and not state.is_leader:
+        # Only the leader updates user_group_info, so queue the events for it
+        await run_blocking(app, state.push_events, events)
+        logger.info(f"Queued {len(events)} membership events for the leader.")
+        return web.json_response({"events": len(events)}, status=202)
+    queue_events(app, events)
+    return web.json_response({"events": len(events)}, status=202)
+
+
+def queue_events(app: web.Application, events: list):
+    """
+    Queue membership events to be applied in a batch with the events that follow them
+    within membership_events_delay seconds.
+    """
+    app["pending_membership_events"].extend(events)
+    task = app.get("membership_events_task")
+    if task is None or task.done():
+        app["membership_events_task"] = asyncio.create_task(apply_queued_events(app))
+
+
+async def apply_queued_events(app: web.Application):
+    """
+    Apply the queued membership events in batches, so that a burst of events updates
+    user_group_info and renders the metrics once rather than once per request.
+    """
+    while app["pending_membership_events"]:
+        await asyncio.sleep(app["membership_events_delay"])
+        events = app["pending_membership_events"]
+        app["pending_membership_events"] = []
         try:
-            data = await update_function(app, config)
-            logger.debug(f"Fetched data for {update_function.__name__}: {data}")
+            await apply_events(app, events)
         except Exception as e:
-            logger.error(f"Error fetching data for {update_function.__name__}: {e}")
-        await asyncio.sleep(int(config["update_interval"]))
+            logger.error(f"Error applying {len(events)} membership events: {e}")
 
 
-async def on_startup(app):
-    app["session"] = aiohttp.ClientSession(headers=app["headers"])
-    logger.info("Client session started.")
-    app["task"] = asyncio.create_task(
-        background_update(
-            app,
-            {"update_interval": f"{app['update_info_interval']}"},
+async def apply_events(app: web.Application, events: list):
+    """
+    Apply membership events to the user index and export the resulting user_group_info.
+    """
+    async with app["user_group_lock"]:
+        app["membership_events"].extend(events)
+        if "user_index" in app:
+            user_index = app["user_index"]
+            apply_membership_events(user_index, events)
+            await set_user_group_info(app, user_index)
+            # Keep the applied events across a restart or a change of leader
+            if app["snapshot_path"] or app["shared_state"] is not None:
+                await save_user_group_snapshot(app, user_index)
+    logger.info(f"Applied {len(events)} membership events.")
+    await refresh_exposition(app)
+
+
+async def refresh_exposition(app: web.Application):
+    """
+    Render the metrics and, if this replica is the leader, publish them to the other replicas.
+    """
+    await run_blocking(app, render_metrics, app)
+    state = app["shared_state"]
+    if state is not None and state.is_leader:
+        try:
+            gzipped_body = app["exposition"]["payload"].get("text", "gzip")
+            await run_blocking(app, state.publish, "metrics", gzipped_body)
+        except sqlite3.Error as e:
+            logger.error(f"Error publishing metrics to shared state: {e}")
+
+
+async def run_update(app: web.Application, config: dict, update_function: callable):
+    """
+    Run one cycle of update_function and render the metrics.
+
+    The duration, items processed and errors of the cycle are recorded under the name of
+    the update. The cycle must finish by the deadline set by the scheduler, shortly before
+    its next cycle is due, or within its update interval when run on its own, or it is
+    cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    interval = int(config["update_interval"])
+    name = config["name"]
+    current_update.set(name)
+    if run_deadline.get() is not None:
+        deadline = asyncio.timeout_at(run_deadline.get())
+    else:
+        deadline = asyncio.timeout(interval)
+    start = loop.time()
+    try:
+        async with deadline:
+            data = await update_function(app, config)
+        logger.debug(f"Fetched data for {update_function.__name__}: {data}")
+        UPDATE_DURATION.labels(name).observe(loop.time() - start)
+        UPDATE_ITEMS.labels(name).inc(data)
+        UPDATE_LAST_SUCCESS.labels(name).set_to_current_time()
+    except TimeoutError as e:
+        UPDATE_ERRORS.labels(name, type(e).__name__).inc()
+        if not deadline.expired():
+            logger.error(f"Error fetching data for {update_function.__name__}: {e!r}")
+        else:
+            UPDATE_DEADLINE_EXCEEDED.labels(name).inc()
+            logger.error(f"Cancelled update of {name} after exceeding its deadline.")
+    except Exception as e:
+        UPDATE_ERRORS.labels(name, type(e).__name__).inc()
+        logger.error(f"Error fetching data for {update_function.__name__}: {e}")
+    await refresh_exposition(app)
+
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    """
+    Observe how late the event loop wakes up from a sleep, i.e. how long it was blocked.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(loop.time() - start - interval, 0))
+
+
+async def load_user_group_snapshot(app: web.Application, snapshot: dict) -> float:
+    """
+    Export user_group_info from a snapshot of the user group index, so that usage metrics
+    are served before the first crawl of the JupyterHub API.
+
+    Returns how long to wait before the first crawl: if the last crawl that the snapshot
+    comes from is more recent than the update interval, the next crawl is due one interval
+    after it, rather than straight away on every restart. Membership events applied since
+    that crawl are saved in the snapshot too.
+    """
+    SLUG_CACHE.load(snapshot["slugs"])
+    async with app["user_group_lock"]:
+        await set_user_group_info(app, snapshot["user_index"])
+    app["snapshot_etag"] = snapshot["etag"]
+    app["user_index_crawled"] = snapshot["crawled"]
+    age = max(time.time() - snapshot["crawled"], 0)
+    logger.info(
+        f"Loaded snapshot of {len(snapshot['user_index'])} users crawled {age:.0f}s ago."
+    )
+    return max(int(app["update_info_interval"]) - age, 0)
+
+
+async def start_updates(app: web.Application):
+    """
+    Start the scheduler of the update jobs, after loading the latest snapshot of the user
+    group index from the shared state of the replicas or the snapshot file, if any.
+    """
+    snapshot = None
+    state = app["shared_state"]
+    if state is not None:
+        published = await run_blocking(app, state.fetch, "user_index")
+        if published is not None:
+            snapshot = decode_snapshot(published[1], app["namespace"])
+        crawled = await run_blocking(app, state.fetch, "user_index_crawled")
+        if snapshot is not None and crawled is not None:
+            snapshot["crawled"] = float(crawled[1])
+    if snapshot is None and app["snapshot_path"]:
+        snapshot = await run_blocking(
+            app, load_snapshot, app["snapshot_path"], app["namespace"]
+        )
+    info_phase = None
+    if snapshot is not None:
+        info_phase = await load_user_group_snapshot(app, snapshot)
+        await refresh_exposition(app)
+    scheduler = Scheduler()
+    for config, update_function in [
+        (
+            {
+                "name": "user_group_info",
+                "update_interval": f"{app['update_info_interval']}",
+            },
             update_user_group_info,
+        ),
+        (
+            {
+                "name": "usage",
+                "update_interval": f"{app['update_metrics_interval']}",
+                "queries": CONFIG_COMPUTE,
+            },
+            update_group_usage,
+        ),
+        (
+            {
+                "name": "home_dir",
+                "update_interval": f"{app['update_dirsize_interval']}",
+                "queries": CONFIG_DIRSIZE,
+            },
+            update_group_usage,
+        ),
+    ]:
+        scheduler.add_job(
+            config["name"],
+            int(config["update_interval"]),
+            run_update,
+            app,
+            config,
+            update_function,
+            phase=info_phase if update_function is update_user_group_info else None,
         )
+    scheduler.start()
+    app["scheduler"] = scheduler
+
+
+async def coordinate_replicas(app: web.Application):
+    """
+    Take part in leader election with the other replicas sharing state.
+
+    The leader runs the update jobs and publishes the rendered metrics, and applies the
+    membership events queued by the other replicas. The others only serve the latest
+    metrics published by the leader.
+    """
+    state = app["shared_state"]
+    version = 0
+    while True:
+        try:
+            if await run_blocking(app, state.acquire_lease):
+                if app["scheduler"] is None:
+                    await start_updates(app)
+                events = await run_blocking(app, state.pop_events)
+                if events:
+                    queue_events(app, events)
+            else:
+                if app["scheduler"] is not None:
+                    await app["scheduler"].stop()
+                    app["scheduler"] = None
+                published = await run_blocking(app, state.fetch, "metrics", version)
+                if published is not None:
+                    version, gzipped_body = published
+                    app["exposition"]["payload"] = await run_blocking(
+                        app, Exposition.from_gzipped_text, gzipped_body
+                    )
+        except sqlite3.Error as e:
+            logger.error(f"Error coordinating with the other replicas: {e}")
+        await asyncio.sleep(state.lease_seconds / 3)
+
+
+async def on_startup(app):
+    app["hub_session"] = make_session(
+        "hub",
+        connection_limit=app["hub_connection_limit"],
+        request_timeout=app["hub_request_timeout"],
+        connect_timeout=app["connect_timeout"],
+        keepalive_timeout=app["keepalive_timeout"],
+        dns_cache_ttl=app["dns_cache_ttl"],
+        headers=app["headers"],
+    )
+    app["prometheus_session"] = make_session(
+        "prometheus",
+        connection_limit=app["prometheus_connection_limit"],
+        request_timeout=app["prometheus_request_timeout"],
+        connect_timeout=app["connect_timeout"],
+        keepalive_timeout=app["keepalive_timeout"],
+        dns_cache_ttl=app["dns_cache_ttl"],
     )
-    for cfg in CONFIG_COMPUTE:
-        cfg.update({"update_interval": f"{app['update_metrics_interval']}"})
-        app["task"] = asyncio.create_task(
-            background_update(app, dict(cfg), update_group_usage)
+    logger.info("Client sessions started.")
+    for upstream in ["hub", "prometheus"]:
+        app[f"{upstream}_policy"] = UpstreamPolicy(
+            upstream,
+            max_retries=app["max_retries"],
+            budget=RetryBudget(ratio=app["retry_budget_ratio"]),
+            breaker=CircuitBreaker(
+                failure_threshold=app["circuit_breaker_failures"],
+                reset_timeout=app["circuit_breaker_reset_timeout"],
+            ),
         )
-    for cfg in CONFIG_DIRSIZE:
-        cfg.update({"update_interval": f"{app['update_dirsize_interval']}"})
-        app["task"] = asyncio.create_task(
-            background_update(app, dict(cfg), update_group_usage)
+    SLUG_CACHE.maxsize = app["slug_cache_size"]
+    for metric, labels in app["username_labels"].items():
+        set_username_labels(USER_GAUGES[metric], labels)
+    app["executor"] = make_executor(app["executor_kind"])
+    logger.info(f"Running CPU-bound work with executor: {app['executor_kind']}.")
+    render_metrics(app)
+    app["lag_task"] = asyncio.create_task(monitor_event_loop_lag())
+    app["scheduler"] = None
+    if app["shared_state_path"]:
+        app["shared_state"] = await run_blocking(
+            app, SharedState, app["shared_state_path"], app["leader_lease_seconds"]
         )
+        app["coordinator_task"] = asyncio.create_task(coordinate_replicas(app))
+    else:
+        await start_updates(app)
 
 
 async def on_cleanup(app):
-    await app["session"].close()
-    logger.info("Client session closed.")
+    state = app["shared_state"]
+    if state is not None:
+        app["coordinator_task"].cancel()
+        if state.is_leader:
+            # Not in a worker thread: the app may be cancelled while cleaning up
+            state.release_lease()
+    if app.get("membership_events_task") is not None:
+        app["membership_events_task"].cancel()
+    try:
+        if state is not None:
+            await asyncio.gather(app["coordinator_task"], return_exceptions=True)
+        if app["scheduler"] is not None:
+            await app["scheduler"].stop()
+    finally:
+        app["lag_task"].cancel()
+        await app["hub_session"].close()
+        await app["prometheus_session"].close()
+        logger.info("Client sessions closed.")
+        if app["executor"] is not None:
+            app["executor"].shutdown(wait=False, cancel_futures=True)
 
 
 def sub_app(
@@ -82,10 +438,38 @@ def sub_app(
     namespace: str = None,
     jupyterhub_metrics_prefix: str = None,
     update_info_interval: int = None,
+    hub_api_concurrency: int = None,
+    full_resync_cycles: int = None,
     update_metrics_interval: int = None,
+    usage_aggregation: str = None,
+    query_shards: int = None,
+    group_aggregates: bool = None,
+    per_user_series: bool = None,
     update_dirsize_interval: int = None,
     prometheus_host: str = None,
     prometheus_port: int = None,
+    hub_connection_limit: int = None,
+    prometheus_connection_limit: int = None,
+    hub_request_timeout: float = None,
+    prometheus_request_timeout: float = None,
+    connect_timeout: float = None,
+    keepalive_timeout: float = None,
+    dns_cache_ttl: int = None,
+    max_retries: int = None,
+    retry_budget_ratio: float = None,
+    circuit_breaker_failures: int = None,
+    circuit_breaker_reset_timeout: float = None,
+    executor: str = None,
+    json_decoder: str = None,
+    slug_cache_size: int = None,
+    username_labels: dict = None,
+    debug_endpoints: bool = None,
+    debug_token: str = None,
+    membership_events_token: str = None,
+    membership_events_delay: float = None,
+    snapshot_path: str = None,
+    shared_state_path: str = None,
+    leader_lease_seconds: float = None,
 ):
     app = web.Application()
     app["headers"] = headers
@@ -95,11 +479,46 @@ def sub_app(
     app["namespace"] = namespace
     app["jupyterhub_metrics_prefix"] = jupyterhub_metrics_prefix
     app["update_info_interval"] = update_info_interval
+    app["hub_api_concurrency"] = hub_api_concurrency
+    app["full_resync_cycles"] = full_resync_cycles
     app["update_metrics_interval"] = update_metrics_interval
+    app["usage_aggregation"] = usage_aggregation
+    app["query_shards"] = query_shards
+    app["group_aggregates"] = group_aggregates
+    app["per_user_series"] = per_user_series
     app["update_dirsize_interval"] = update_dirsize_interval
     app["prometheus_host"] = prometheus_host
     app["prometheus_port"] = prometheus_port
+    app["hub_connection_limit"] = hub_connection_limit
+    app["prometheus_connection_limit"] = prometheus_connection_limit
+    app["hub_request_timeout"] = hub_request_timeout
+    app["prometheus_request_timeout"] = prometheus_request_timeout
+    app["connect_timeout"] = connect_timeout
+    app["keepalive_timeout"] = keepalive_timeout
+    app["dns_cache_ttl"] = dns_cache_ttl
+    app["max_retries"] = max_retries
+    app["retry_budget_ratio"] = retry_budget_ratio
+    app["circuit_breaker_failures"] = circuit_breaker_failures
+    app["circuit_breaker_reset_timeout"] = circuit_breaker_reset_timeout
+    app["executor_kind"] = executor
+    app["json_decoder"] = json_decoder
+    app["slug_cache_size"] = slug_cache_size
+    app["username_labels"] = username_labels or {}
+    app["exposition"] = {"negotiated": set()}
+    app["membership_events"] = []
+    app["user_group_lock"] = asyncio.Lock()
+    app["membership_events_token"] = membership_events_token
+    app["membership_events_delay"] = membership_events_delay
+    app["pending_membership_events"] = []
+    app["snapshot_path"] = snapshot_path
+    app["shared_state_path"] = shared_state_path
+    app["leader_lease_seconds"] = leader_lease_seconds
+    app["shared_state"] = None
     app.router.add_get("/", handle)
+    if membership_events_token:
+        app.router.add_post("/membership-events", handle_membership_events)
+    if debug_endpoints:
+        add_debug_routes(app, debug_token)
     app.on_startup.append(on_startup)
     app.on_cleanup.append(on_cleanup)
     return app
@@ -120,11 +539,48 @@ def main():
         type=int,
         help="Time interval between each update of the user_group_info metric (seconds).",
     )
+    argparser.add_argument(
+        "--hub_api_concurrency",
+        default=8,
+        type=int,
+        help="Maximum number of concurrent page requests to the JupyterHub API.",
+    )
+    argparser.add_argument(
+        "--full_resync_cycles",
+        default=1,
+        type=int,
+        help="Number of user_group_info updates between full crawls of the JupyterHub users API. In between, group memberships are refreshed incrementally from the groups API. Defaults to 1, i.e. a full crawl on every update.",
+    )
     argparser.add_argument(
         "--update_metrics_interval",
         type=int,
         help="Time interval between each update of the group usage metrics (seconds).",
     )
+    argparser.add_argument(
+        "--usage_aggregation",
+        default="last",
+        choices=["last", "avg", "max"],
+        type=str,
+        help="How to aggregate usage over each update interval. 'last' exports the latest value from an instant query, while 'avg' and 'max' aggregate a range query over the interval.",
+    )
+    argparser.add_argument(
+        "--query_shards",
+        default=1,
+        type=int,
+        help="Number of shards, by first character of the username, that each Prometheus usage query is split into and fetched concurrently (up to 36).",
+    )
+    argparser.add_argument(
+        "--group_aggregates",
+        default="false",
+        type=_str_to_bool,
+        help="If 'true', export per-group counts, sums and quantiles of each usage metric, computed by the exporter.",
+    )
+    argparser.add_argument(
+        "--per_user_series",
+        default="true",
+        type=_str_to_bool,
+        help="If 'false', do not export per-user series of the usage metrics. The user_group_info metric is always exported per user.",
+    )
     argparser.add_argument(
         "--update_dirsize_interval",
         type=int,
@@ -190,6 +646,141 @@ def main():
         type=int,
         help="Prometheus port.",
     )
+    argparser.add_argument(
+        "--hub_connection_limit",
+        default=16,
+        type=int,
+        help="Maximum number of connections in the pool for the JupyterHub API.",
+    )
+    argparser.add_argument(
+        "--prometheus_connection_limit",
+        default=16,
+        type=int,
+        help="Maximum number of connections in the pool for Prometheus.",
+    )
+    argparser.add_argument(
+        "--hub_request_timeout",
+        default=30,
+        type=float,
+        help="Timeout for each request to the JupyterHub API, including reading the response (seconds).",
+    )
+    argparser.add_argument(
+        "--prometheus_request_timeout",
+        default=120,
+        type=float,
+        help="Timeout for each query to Prometheus, including reading the response (seconds).",
+    )
+    argparser.add_argument(
+        "--connect_timeout",
+        default=10,
+        type=float,
+        help="Timeout for getting a connection, either by waiting for a free connection in the pool or opening a new one (seconds).",
+    )
+    argparser.add_argument(
+        "--keepalive_timeout",
+        default=60,
+        type=float,
+        help="Time to keep idle connections open for reuse (seconds).",
+    )
+    argparser.add_argument(
+        "--dns_cache_ttl",
+        default=10,
+        type=int,
+        help="Time to cache DNS lookups of the JupyterHub and Prometheus hosts (seconds).",
+    )
+    argparser.add_argument(
+        "--max_retries",
+        default=5,
+        type=int,
+        help="Maximum number of times to retry a failed request to the JupyterHub API or Prometheus.",
+    )
+    argparser.add_argument(
+        "--retry_budget_ratio",
+        default=0.2,
+        type=float,
+        help="Maximum ratio of retries to requests for each of the JupyterHub API and Prometheus, shared by all updates.",
+    )
+    argparser.add_argument(
+        "--circuit_breaker_failures",
+        default=5,
+        type=int,
+        help="Number of consecutive failed requests to the JupyterHub API or Prometheus after which requests to it fail fast.",
+    )
+    argparser.add_argument(
+        "--circuit_breaker_reset_timeout",
+        default=30,
+        type=float,
+        help="Time to fail requests fast once the circuit breaker opens, before trying the upstream again (seconds).",
+    )
+    argparser.add_argument(
+        "--executor",
+        default="thread",
+        choices=EXECUTOR_KINDS,
+        type=str,
+        help="Where to run CPU-bound work such as joins and rendering the metrics: 'thread' or 'process' worker pools, or 'none' to run it on the event loop.",
+    )
+    argparser.add_argument(
+        "--json_decoder",
+        default="json",
+        choices=JSON_DECODERS,
+        type=str,
+        help="JSON decoder for the responses of the JupyterHub API and Prometheus: the standard library 'json', or 'orjson' if installed.",
+    )
+    argparser.add_argument(
+        "--slug_cache_size",
+        default=100000,
+        type=int,
+        help="Maximum number of usernames to keep in the cache of escaped usernames.",
+    )
+    argparser.add_argument(
+        "--username_labels",
+        nargs="*",
+        default=[],
+        type=_parse_username_labels,
+        help="Username labels to keep on a metric, as METRIC=LABEL,LABEL, e.g. user_group_memory_bytes=username. Labels are one or more of username, username_escaped and username_safe. Metrics not listed keep all three.",
+    )
+    argparser.add_argument(
+        "--snapshot_path",
+        default=None,
+        type=str,
+        help="Path of a snapshot of user group memberships, written after each update of user_group_info and loaded on startup to serve metrics before the first update. Put it on a persistent volume. If not provided, no snapshot is kept.",
+    )
+    argparser.add_argument(
+        "--shared_state_path",
+        default=None,
+        type=str,
+        help="Path of a SQLite database on a volume shared by several replicas of the exporter. If provided, only the replica elected as leader fetches and renders the metrics, and the others serve the metrics it publishes.",
+    )
+    argparser.add_argument(
+        "--leader_lease_seconds",
+        default=30,
+        type=float,
+        help="Time after which another replica takes over if the leader stops renewing its lease (seconds).",
+    )
+    argparser.add_argument(
+        "--membership_events_token",
+        default=os.environ.get("GROUPS_EXPORTER_MEMBERSHIP_EVENTS_TOKEN"),
+        type=str,
+        help="Token that JupyterHub hooks must send to post group membership events to the membership-events endpoint. The endpoint is only served if a token is set.",
+    )
+    argparser.add_argument(
+        "--membership_events_delay",
+        default=1,
+        type=float,
+        help="Time to wait for more membership events before applying them in one batch (seconds).",
+    )
+    argparser.add_argument(
+        "--debug_endpoints",
+        default="false",
+        type=_str_to_bool,
+        help="If 'true', serve debug endpoints to profile the exporter, trace its memory allocations and dump its asyncio tasks.",
+    )
+    argparser.add_argument(
+        "--debug_token",
+        default=os.environ.get("GROUPS_EXPORTER_DEBUG_TOKEN"),
+        type=str,
+        help="Token that requests to the debug endpoints must send. Required with --debug_endpoints.",
+    )
     argparser.add_argument(
         "--log_level",
         default="INFO",
@@ -199,6 +790,10 @@ def main():
     )
 
     args = argparser.parse_args()
+    if args.json_decoder == "orjson" and orjson is None:
+        argparser.error("--json_decoder orjson requires the orjson package.")
+    if args.debug_endpoints and not args.debug_token:
+        argparser.error("--debug_endpoints requires --debug_token.")
 
     logging.basicConfig(
         level=getattr(logging, args.log_level),
@@ -218,6 +813,14 @@ def main():
             f"Double-count users with multiple group memberships: {args.double_count}"
         )
 
+    args.username_labels = dict(args.username_labels)
+    if not {"username", "username_escaped"} <= set(
+        args.username_labels.get("user_group_info", USERNAME_LABELS)
+    ):
+        logger.warning(
+            "The user_group_home_dir_bytes query joins on the username and username_escaped labels of user_group_info."
+        )
+
     if args.jupyterhub_metrics_prefix:
         os.environ["JUPYTERHUB_METRICS_PREFIX"] = args.jupyterhub_metrics_prefix
 
@@ -241,10 +844,38 @@ def main():
         namespace=args.jupyterhub_namespace,
         jupyterhub_metrics_prefix=args.jupyterhub_metrics_prefix,
         update_info_interval=args.update_info_interval,
+        hub_api_concurrency=args.hub_api_concurrency,
+        full_resync_cycles=args.full_resync_cycles,
         update_metrics_interval=args.update_metrics_interval,
+        usage_aggregation=args.usage_aggregation,
+        query_shards=args.query_shards,
+        group_aggregates=args.group_aggregates,
+        per_user_series=args.per_user_series,
         update_dirsize_interval=args.update_dirsize_interval,
         prometheus_host=args.prometheus_host,
         prometheus_port=args.prometheus_port,
+        hub_connection_limit=args.hub_connection_limit,
+        prometheus_connection_limit=args.prometheus_connection_limit,
+        hub_request_timeout=args.hub_request_timeout,
+        prometheus_request_timeout=args.prometheus_request_timeout,
+        connect_timeout=args.connect_timeout,
+        keepalive_timeout=args.keepalive_timeout,
+        dns_cache_ttl=args.dns_cache_ttl,
+        max_retries=args.max_retries,
+        retry_budget_ratio=args.retry_budget_ratio,
+        circuit_breaker_failures=args.circuit_breaker_failures,
+        circuit_breaker_reset_timeout=args.circuit_breaker_reset_timeout,
+        executor=args.executor,
+        json_decoder=args.json_decoder,
+        slug_cache_size=args.slug_cache_size,
+        username_labels=args.username_labels,
+        debug_endpoints=args.debug_endpoints,
+        debug_token=args.debug_token,
+        membership_events_token=args.membership_events_token,
+        membership_events_delay=args.membership_events_delay,
+        snapshot_path=args.snapshot_path,
+        shared_state_path=args.shared_state_path,
+        leader_lease_seconds=args.leader_lease_seconds,
     )
     app.add_subapp(args.hub_service_prefix, metrics_app)
     web.run_app(app, port=args.port)
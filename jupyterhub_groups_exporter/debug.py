@@ -0,0 +1,177 @@
+"""
+Opt-in debug endpoints to look inside a running exporter.
+"""
+
+import asyncio
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from functools import wraps
+
+from aiohttp import web
+
+MAX_SECONDS = 300
+
+
+def _query_int(request: web.Request, name: str, default: int, maximum: int) -> int:
+    try:
+        value = int(request.query.get(name, default))
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"{name} must be an integer.")
+    if not 0 < value <= maximum:
+        raise web.HTTPBadRequest(text=f"{name} must be between 1 and {maximum}.")
+    return value
+
+
+def _token_required(handler: callable) -> callable:
+    """
+    Reject requests to the handler without the debug token in their Authorization header.
+    """
+
+    @wraps(handler)
+    async def wrapper(request: web.Request):
+        authorization = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(
+            authorization.encode(), f"token {request.app['debug_token']}".encode()
+        ):
+            raise web.HTTPForbidden(text="Invalid debug token.")
+        return await handler(request)
+
+    return wrapper
+
+
+async def profile(request: web.Request):
+    """
+    Profile the event loop with cProfile for the given number of seconds.
+
+    cProfile only sees the thread it is enabled in, so the profile covers the update
+    coroutines and the handlers running on the event loop, but not the work they hand
+    off to the executor or the default thread pool, such as rendering the metrics.
+    """
+    seconds = _query_int(request, "seconds", 10, MAX_SECONDS)
+    limit = _query_int(request, "limit", 50, 1000)
+    sort = request.query.get("sort", "cumulative")
+    if sort not in pstats.Stats.sort_arg_dict_default:
+        raise web.HTTPBadRequest(
+            text=f"sort must be one of {sorted(pstats.Stats.sort_arg_dict_default)}."
+        )
+    lock = request.app["debug_lock"]
+    if lock.locked():
+        raise web.HTTPConflict(text="A profile is already running.")
+    async with lock:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats(sort).print_stats(limit)
+    return web.Response(text=output.getvalue())
+
+
+async def allocations(request: web.Request):
+    """
+    Trace memory allocations for the given number of seconds and return the source lines
+    holding the most memory allocated in that time.
+
+    If tracemalloc was already tracing, e.g. with PYTHONTRACEMALLOC, allocations since it
+    started are included and it is left running.
+    """
+    seconds = _query_int(request, "seconds", 10, MAX_SECONDS)
+    limit = _query_int(request, "limit", 25, 1000)
+    lock = request.app["debug_lock"]
+    if lock.locked():
+        raise web.HTTPConflict(text="A profile is already running.")
+    async with lock:
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        try:
+            await asyncio.sleep(seconds)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            if started:
+                tracemalloc.stop()
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    stats = snapshot.statistics("lineno")
+    total = sum(stat.size for stat in stats)
+    lines = [f"Total traced: {total / 1024:.1f} KiB"]
+    lines.extend(str(stat) for stat in stats[:limit])
+    return web.Response(text="\n".join(lines) + "\n")
+
+
+def _sample_stacks(seconds: int, interval: float) -> Counter:
+    """
+    Sample the stack of every other thread each interval for the given number of seconds,
+    and count the samples of each stack, in the collapsed format of flame graph tools.
+    """
+    this_thread = threading.get_ident()
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == this_thread:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                filename = os.path.basename(code.co_filename)
+                stack.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stacks[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+async def stacks(request: web.Request):
+    """
+    Sample the stacks of all threads, including the event loop and worker pool threads,
+    for the given number of seconds and return the most sampled stacks.
+
+    Sampling runs in its own thread, so it sees work handed off to thread pools that
+    cProfile misses. Idle worker threads are sampled too, waiting for work.
+    """
+    seconds = _query_int(request, "seconds", 10, MAX_SECONDS)
+    interval = _query_int(request, "interval_ms", 10, 1000) / 1000
+    limit = _query_int(request, "limit", 50, 10000)
+    lock = request.app["debug_lock"]
+    if lock.locked():
+        raise web.HTTPConflict(text="A profile is already running.")
+    async with lock:
+        loop = asyncio.get_running_loop()
+        samples = await loop.run_in_executor(None, _sample_stacks, seconds, interval)
+    lines = [f"{stack} {count}" for stack, count in samples.most_common(limit)]
+    return web.Response(text="\n".join(lines) + "\n")
+
+
+async def tasks(request: web.Request):
+    """
+    Dump the stack of every asyncio task running in the exporter.
+    """
+    output = io.StringIO()
+    for task in sorted(asyncio.all_tasks(), key=lambda task: task.get_name()):
+        task.print_stack(file=output)
+        output.write("\n")
+    return web.Response(text=output.getvalue())
+
+
+def add_debug_routes(app: web.Application, token: str):
+    """
+    Add the debug endpoints under /debug/ of the app, for requests with the token.
+    """
+    app["debug_lock"] = asyncio.Lock()
+    app["debug_token"] = token
+    app.router.add_get("/debug/profile", _token_required(profile))
+    app.router.add_get("/debug/stacks", _token_required(stacks))
+    app.router.add_get("/debug/allocations", _token_required(allocations))
+    app.router.add_get("/debug/tasks", _token_required(tasks))
@@ -0,0 +1,50 @@
+"""
+Worker pools to keep CPU-bound work off the aiohttp event loop.
+"""
+
+import asyncio
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from aiohttp import web
+
+EXECUTOR_KINDS = ["none", "thread", "process"]
+
+
+def make_executor(kind: str) -> Executor | None:
+    """
+    Create the worker pool for the given executor kind, or None to run work on the event loop.
+
+    Worker processes are started by a fork server, since the exporter already runs threads.
+    """
+    if kind == "thread":
+        return ThreadPoolExecutor(thread_name_prefix="groups-exporter")
+    elif kind == "process":
+        # Forking a process that already runs threads can deadlock its children
+        return ProcessPoolExecutor(mp_context=multiprocessing.get_context("forkserver"))
+    return None
+
+
+async def run_cpu_bound(app: web.Application, func: callable, *args):
+    """
+    Run a pure, CPU-bound function in the configured worker pool.
+
+    The function and its arguments must be picklable when running in a process pool.
+    """
+    if app["executor"] is None:
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app["executor"], func, *args)
+
+
+async def run_blocking(app: web.Application, func: callable, *args):
+    """
+    Run a function that touches in-process state, e.g. the metrics registry, in a worker thread.
+
+    Unless the executor kind is 'none', this always uses the event loop's default thread pool,
+    since in-process state cannot be shared with a process pool.
+    """
+    if app["executor"] is None:
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, func, *args)
@@ -0,0 +1,383 @@
+"""
+Metrics exposition in the format and compression negotiated with each scraper.
+"""
+
+import gzip
+import struct
+import threading
+from functools import partial
+
+from prometheus_client import REGISTRY, CollectorRegistry
+from prometheus_client.exposition import CONTENT_TYPE_LATEST as CONTENT_TYPE_TEXT
+from prometheus_client.exposition import generate_latest
+from prometheus_client.openmetrics.exposition import (
+    CONTENT_TYPE_LATEST as CONTENT_TYPE_OPENMETRICS,
+)
+from prometheus_client.openmetrics.exposition import (
+    generate_latest as generate_openmetrics,
+)
+
+try:
+    from compression.zstd import compress as zstd_compress
+except ImportError:
+    try:
+        import zstandard
+    except ImportError:
+        zstd_compress = None
+    else:
+
+        def zstd_compress(data: bytes) -> bytes:
+            return zstandard.ZstdCompressor().compress(data)
+
+
+CONTENT_TYPE_PROTOBUF = (
+    "application/vnd.google.protobuf; "
+    "proto=io.prometheus.client.MetricFamily; encoding=delimited"
+)
+
+# Compressions in order of preference when a scraper accepts several equally
+COMPRESSORS = {"gzip": partial(gzip.compress, compresslevel=6, mtime=0)}
+if zstd_compress is not None:
+    COMPRESSORS = {"zstd": zstd_compress, **COMPRESSORS}
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _key(field: int, wire_type: int) -> bytes:
+    return _varint(field << 3 | wire_type)
+
+
+def _bytes(field: int, data: bytes) -> bytes:
+    return _key(field, 2) + _varint(len(data)) + data
+
+
+def _string(field: int, value: str) -> bytes:
+    return _bytes(field, value.encode())
+
+
+def _double(field: int, value: float) -> bytes:
+    return _key(field, 1) + struct.pack("<d", value)
+
+
+def _uint(field: int, value: int) -> bytes:
+    return _key(field, 0) + _varint(value)
+
+
+def _timestamp(field: int, seconds: float) -> bytes:
+    nanos = round(seconds % 1 * 1e9)
+    return _bytes(field, _uint(1, int(seconds)) + _uint(2, nanos))
+
+
+# MetricFamily.type values of io.prometheus.client.MetricType
+PROTOBUF_TYPES = {"counter": 0, "gauge": 1, "summary": 2, "untyped": 3, "histogram": 4}
+
+
+class _ProtobufEncoder:
+    """
+    Encoder of collected metric families as length-delimited io.prometheus.client
+    MetricFamily protobuf messages.
+
+    Label pairs are encoded once per render and shared by all series with the same label
+    name and value, e.g. the usernames of the series of every usage metric.
+    """
+
+    def __init__(self):
+        self._label_pairs = {}
+
+    def _labels(self, labels: dict, skip: str = None) -> bytes:
+        out = b""
+        for name, value in labels.items():
+            if name == skip:
+                continue
+            pair = self._label_pairs.get((name, value))
+            if pair is None:
+                pair = _bytes(1, _string(1, name) + _string(2, value))
+                self._label_pairs[(name, value)] = pair
+            out += pair
+        return out
+
+    def _simple_families(self, metric) -> list:
+        """
+        Encode each sample of a gauge-like family as a series of a gauge or untyped family,
+        with one family per sample name.
+        """
+        type_name = (
+            "gauge" if metric.type in ("gauge", "info", "stateset") else "untyped"
+        )
+        # Gauge and Untyped messages both have their value in field 1
+        value_field = 2 if type_name == "gauge" else 5
+        families = {}
+        for sample in metric.samples:
+            series = self._labels(sample.labels) + _bytes(
+                value_field, _double(1, sample.value)
+            )
+            if sample.timestamp is not None:
+                series += _uint(6, int(float(sample.timestamp) * 1000))
+            families.setdefault(sample.name, []).append(series)
+        return [(name, type_name, series) for name, series in families.items()]
+
+    def _grouped_series(self, metric, skip: str) -> dict:
+        """
+        Group the samples of a counter, summary or histogram by their labels, other than
+        the quantile or bucket label skip.
+        """
+        groups = {}
+        for sample in metric.samples:
+            labels = self._labels(sample.labels, skip)
+            groups.setdefault(labels, []).append(sample)
+        return groups
+
+    def _counter_families(self, metric) -> list:
+        series = []
+        for labels, samples in self._grouped_series(metric, None).items():
+            counter = b""
+            for sample in samples:
+                if sample.name.endswith("_created"):
+                    counter += _timestamp(3, sample.value)
+                else:
+                    counter += _double(1, sample.value)
+            series.append(labels + _bytes(3, counter))
+        return [(f"{metric.name}_total", "counter", series)]
+
+    def _summary_families(self, metric) -> list:
+        series = []
+        for labels, samples in self._grouped_series(metric, "quantile").items():
+            summary = b""
+            for sample in samples:
+                if sample.name == f"{metric.name}_count":
+                    summary += _uint(1, int(sample.value))
+                elif sample.name == f"{metric.name}_sum":
+                    summary += _double(2, sample.value)
+                elif sample.name == f"{metric.name}_created":
+                    summary += _timestamp(4, sample.value)
+                else:
+                    quantile = float(sample.labels["quantile"])
+                    summary += _bytes(
+                        3, _double(1, quantile) + _double(2, sample.value)
+                    )
+            series.append(labels + _bytes(4, summary))
+        return [(metric.name, "summary", series)]
+
+    def _histogram_families(self, metric) -> list:
+        series = []
+        for labels, samples in self._grouped_series(metric, "le").items():
+            histogram = b""
+            for sample in samples:
+                if sample.name == f"{metric.name}_count":
+                    histogram += _uint(1, int(sample.value))
+                elif sample.name == f"{metric.name}_sum":
+                    histogram += _double(2, sample.value)
+                elif sample.name == f"{metric.name}_created":
+                    histogram += _timestamp(15, sample.value)
+                elif sample.labels["le"] != "+Inf":
+                    # The +Inf bucket is implied by the sample count
+                    upper_bound = float(sample.labels["le"])
+                    histogram += _bytes(
+                        3, _uint(1, int(sample.value)) + _double(2, upper_bound)
+                    )
+            series.append(labels + _bytes(7, histogram))
+        return [(metric.name, "histogram", series)]
+
+    def encode(self, registry: CollectorRegistry) -> bytes:
+        out = bytearray()
+        for metric in registry.collect():
+            if metric.type == "counter":
+                families = self._counter_families(metric)
+            elif metric.type == "summary":
+                families = self._summary_families(metric)
+            elif metric.type == "histogram":
+                families = self._histogram_families(metric)
+            else:
+                families = self._simple_families(metric)
+            for name, type_name, series in families:
+                family = bytearray(_string(1, name))
+                family += _string(2, metric.documentation)
+                family += _uint(3, PROTOBUF_TYPES[type_name])
+                for s in series:
+                    family += _bytes(4, s)
+                out += _varint(len(family))
+                out += family
+        return bytes(out)
+
+
+def generate_protobuf(registry: CollectorRegistry = REGISTRY) -> bytes:
+    """
+    Render the metrics of the registry in the delimited Prometheus protobuf format.
+    """
+    return _ProtobufEncoder().encode(registry)
+
+
+# Formats by name, with their content type and renderer
+FORMATS = {
+    "text": (CONTENT_TYPE_TEXT, generate_latest),
+    "openmetrics": (CONTENT_TYPE_OPENMETRICS, generate_openmetrics),
+    "protobuf": (CONTENT_TYPE_PROTOBUF, generate_protobuf),
+}
+
+# Formats and compressions rendered with each cycle before any scraper asks for them:
+# gzipped OpenMetrics is what Prometheus negotiates by default
+PRERENDERED = [("text", "gzip"), ("openmetrics", "gzip")]
+
+
+def _parse_header(header: str) -> list:
+    """
+    Parse a comma-separated header such as Accept or Accept-Encoding into its values, with
+    their parameters and quality, from the most to the least preferred.
+
+    Values with a quality of 0, which the client refuses, are kept, so that they can
+    override a wildcard that would otherwise accept them.
+    """
+    values = []
+    for i, item in enumerate(header.split(",")):
+        value, *parameters = (part.strip() for part in item.split(";"))
+        if not value:
+            continue
+        params = {}
+        for parameter in parameters:
+            name, _, param_value = parameter.partition("=")
+            params[name.strip().lower()] = param_value.strip().strip('"')
+        try:
+            quality = float(params.pop("q", 1))
+        except ValueError:
+            quality = 0
+        values.append((-max(quality, 0), i, value.lower(), params))
+    return [(value, params, -quality) for quality, _, value, params in sorted(values)]
+
+
+# Formats matched by each wildcard media range, in order of preference. Protobuf is only
+# served to scrapers that ask for it by name.
+WILDCARD_FORMATS = {
+    "*/*": ["text", "openmetrics"],
+    "text/*": ["text"],
+    "application/*": ["openmetrics"],
+}
+
+
+def _media_format(media_type: str, params: dict) -> str | None:
+    """
+    Get the name of the format of a media type, or None if it is not one of the formats.
+    """
+    if media_type == "application/vnd.google.protobuf":
+        if (
+            params.get("proto") == "io.prometheus.client.MetricFamily"
+            and params.get("encoding") == "delimited"
+        ):
+            return "protobuf"
+    elif media_type == "application/openmetrics-text":
+        return "openmetrics"
+    elif media_type == "text/plain":
+        return "text"
+    return None
+
+
+def negotiate_format(accept: str, formats: list) -> str:
+    """
+    Choose the most preferred of the formats accepted by a scraper.
+
+    A wildcard matches the formats the scraper does not refuse by name with a quality of
+    0. If the scraper accepts none of the formats, the first of text and OpenMetrics that
+    it does not refuse is served, or else the text format.
+    """
+    media_ranges = _parse_header(accept)
+    refused = {
+        _media_format(media_type, params)
+        for media_type, params, quality in media_ranges
+        if quality == 0
+    }
+    for media_type, params, quality in media_ranges:
+        if quality == 0:
+            break
+        candidates = WILDCARD_FORMATS.get(media_type) or [
+            _media_format(media_type, params)
+        ]
+        for fmt in candidates:
+            if fmt in formats and fmt not in refused:
+                return fmt
+    for fmt in ("text", "openmetrics"):
+        if fmt in formats and fmt not in refused:
+            return fmt
+    return "text"
+
+
+def negotiate_encoding(accept_encoding: str) -> str:
+    """
+    Choose the compression a scraper accepts with the highest quality, preferring zstd to
+    gzip, or 'identity' if it accepts neither.
+    """
+    accepted = {value: quality for value, _, quality in _parse_header(accept_encoding)}
+    wildcard = accepted.get("*")
+    qualities = {encoding: accepted.get(encoding, wildcard) for encoding in COMPRESSORS}
+    ranked = [
+        (-qualities[encoding], preference, encoding)
+        for preference, encoding in enumerate(COMPRESSORS)
+        if qualities[encoding]
+    ]
+    if not ranked:
+        return "identity"
+    return min(ranked)[2]
+
+
+class _CollectedRegistry:
+    """
+    Metric families collected once from a registry, which can be encoded in each format
+    like the registry itself.
+    """
+
+    def __init__(self, registry: CollectorRegistry):
+        self._families = list(registry.collect())
+
+    def collect(self):
+        return iter(self._families)
+
+
+class Exposition:
+    """
+    Exposition of the metrics of one update cycle.
+
+    The metric families are collected from the registry when the exposition is made, so
+    that every format serves the same state of the cycle. Each format and compression is
+    encoded the first time it is rendered, and cached until the next cycle replaces the
+    exposition. An exposition made from the text published by the leader replica has no
+    registry, so it is only served in the text format.
+    """
+
+    def __init__(self, registry: CollectorRegistry = REGISTRY):
+        self.registry = _CollectedRegistry(registry) if registry is not None else None
+        self.formats = list(FORMATS) if registry is not None else ["text"]
+        self._bodies = {}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_gzipped_text(cls, gzipped_text: bytes) -> "Exposition":
+        exposition = cls(registry=None)
+        exposition._bodies[("text", "gzip")] = gzipped_text
+        exposition._bodies[("text", "identity")] = gzip.decompress(gzipped_text)
+        return exposition
+
+    def get(self, fmt: str, encoding: str) -> bytes | None:
+        """
+        Get the body in the format and compression if it has already been rendered.
+        """
+        return self._bodies.get((fmt, encoding))
+
+    def render(self, fmt: str, encoding: str) -> bytes:
+        """
+        Render the body in the format and compression, or get it from the cache.
+        """
+        with self._lock:
+            body = self._bodies.get((fmt, encoding))
+            if body is None:
+                if encoding == "identity":
+                    _, generate = FORMATS[fmt]
+                    body = generate(self.registry)
+                else:
+                    body = COMPRESSORS[encoding](self.render(fmt, "identity"))
+                self._bodies[(fmt, encoding)] = body
+            return body
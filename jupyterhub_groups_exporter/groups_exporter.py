@@ -1,41 +1,231 @@
-import copy
+import asyncio
+import contextvars
+import json
 import logging
+import math
+import sqlite3
 import string
-from collections import Counter
+import threading
+import time
+from collections import OrderedDict
+from contextlib import aclosing
 from datetime import datetime, timedelta
+from functools import partial
+from operator import itemgetter
 
 import aiohttp
-import backoff
 import escapism
 from aiohttp import web
+from prometheus_client import REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 from yarl import URL
 
+from .executor import run_blocking, run_cpu_bound
 from .kubespawner_slugs import safe_slug
-from .metrics import USER_GROUP
+from .metrics import (
+    QUERY_BYTES,
+    QUERY_DURATION,
+    QUERY_ERRORS,
+    QUERY_LAST_SUCCESS,
+    QUERY_RESULTS,
+    UPDATE_BYTES,
+    UPDATE_PAGES,
+    USER_GROUP,
+    USER_LABELNAMES,
+)
+from .metrics import namespace as metrics_namespace
+from .resilience import UpstreamPolicy
+from .snapshot import encode_snapshot, touch_snapshot, write_snapshot
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+JSON_DECODERS = ["json", "orjson"]
+
+_escape_safe_chars = set(string.ascii_lowercase + string.digits)
+
+# Names of the update and the usage query that requests are made for, to label their metrics
+current_update = contextvars.ContextVar("current_update", default="none")
+current_query = contextvars.ContextVar("current_query", default=None)
+
 
-@backoff.on_exception(backoff.expo, aiohttp.ClientError, max_tries=12, logger=logger)
 async def fetch_page(
-    session: aiohttp.ClientSession, url: URL, path: str = False, params: dict = None
+    session: aiohttp.ClientSession,
+    url: URL,
+    path: str = False,
+    params: dict = None,
+    loads: callable = json.loads,
+    policy: UpstreamPolicy = None,
 ):
     """
     Fetch a page from the JupyterHub API.
+
+    Error statuses are raised as aiohttp.ClientResponseError. Connection errors, timeouts,
+    server errors and rate limiting are retried according to the retry policy of the
+    upstream, if given.
     """
     url = url / path if path else url
-    logger.debug(f"Fetching {url}")
-    async with session.get(url, params=params) as response:
-        return await response.json()
+
+    async def request():
+        logger.debug(f"Fetching {url}")
+        async with session.get(url, params=params) as response:
+            response.raise_for_status()
+            body = await response.read()
+            data = await response.json(loads=loads)
+        UPDATE_PAGES.labels(current_update.get()).inc()
+        UPDATE_BYTES.labels(current_update.get()).inc(len(body))
+        if current_query.get() is not None:
+            QUERY_BYTES.labels(current_query.get()).inc(len(body))
+        return data
+
+    if policy is None:
+        return await request()
+    return await policy.call(request)
+
+
+async def iter_pages(
+    session: aiohttp.ClientSession,
+    url: URL,
+    path: str,
+    semaphore: asyncio.Semaphore,
+    params: dict = None,
+    policy: UpstreamPolicy = None,
+    loads: callable = json.loads,
+):
+    """
+    Yield the items of each page of a paginated JupyterHub API endpoint as it arrives.
+
+    The first page tells us the page limit and the total number of items, so the
+    remaining pages are requested concurrently by offset rather than by following
+    the `next` links one at a time. The semaphore caps the number of requests in flight.
+    Pages are yielded in order of arrival, so callers can fold each page into a compact
+    index and drop it instead of holding every page in memory.
+    """
+    params = dict(params or {})
+    async with semaphore:
+        data = await fetch_page(
+            session, url, path, params=params, loads=loads, policy=policy
+        )
+    if "_pagination" not in data:
+        logger.debug("Received non-paginated data.")
+        yield data
+        return
+    pagination = data["_pagination"]
+    logger.debug(f"Received paginated data: {pagination}")
+    yield data.pop("items")
+    limit = pagination["limit"]
+    offsets = range(pagination["offset"] + limit, pagination["total"], limit)
+
+    async def fetch_offset(offset: int) -> list:
+        async with semaphore:
+            page = await fetch_page(
+                session,
+                url,
+                path,
+                params={**params, "offset": offset, "limit": limit},
+                loads=loads,
+                policy=policy,
+            )
+        return page["items"]
+
+    tasks = [asyncio.create_task(fetch_offset(o)) for o in offsets]
+    try:
+        for page in asyncio.as_completed(tasks):
+            yield await page
+    finally:
+        # Do not leave pages fetching in the background if a page fails or the crawl
+        # is cancelled or stops consuming pages
+        await cancel_tasks(tasks)
+
+
+async def cancel_tasks(tasks: list):
+    """
+    Cancel the tasks that are still running and wait for them to finish.
+    """
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def gather_or_cancel(*coros):
+    """
+    Run the coroutines concurrently like asyncio.gather, but cancel the others as soon as
+    one of them fails.
+    """
+    tasks = [asyncio.create_task(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        await cancel_tasks(tasks)
+
+
+async def crawl_new_users(
+    session: aiohttp.ClientSession,
+    url: URL,
+    semaphore: asyncio.Semaphore,
+    known: frozenset,
+    offset: int,
+    fold: callable,
+    policy: UpstreamPolicy = None,
+    loads: callable = json.loads,
+    limit: int = 200,
+) -> int:
+    """
+    Fold the pages of users created since the known users were crawled, and return the
+    total number of users in the Hub.
+
+    The users API lists users in order of creation, so new users are at its tail, from
+    offset, the total at the last crawl. Users deleted since then shift new users back
+    before offset, so pages are also fetched backwards from offset until a page holds a
+    known user.
+    """
+    pages = iter_pages(
+        session, url, "hub/api/users", semaphore, {"offset": offset}, policy, loads
+    )
+    async with aclosing(pages):
+        async for items in pages:
+            fold(items)
+    total = offset
+    end = offset
+    while end > 0:
+        start = max(end - limit, 0)
+        async with semaphore:
+            data = await fetch_page(
+                session,
+                url,
+                "hub/api/users",
+                params={"offset": start, "limit": end - start},
+                loads=loads,
+                policy=policy,
+            )
+        if "_pagination" not in data:
+            # Hubs without pagination list all users on every page
+            fold(data)
+            return len(data)
+        pagination = data["_pagination"]
+        total = pagination["total"]
+        if pagination["limit"] < end - start:
+            # The Hub caps the page size below our limit
+            limit = pagination["limit"]
+            continue
+        items = data["items"]
+        fold(items)
+        if any(r["name"] in known for r in items):
+            break
+        end = start
+    return total
 
 
 def _escape_username(username: str) -> str:
     """
     Escape the username when a 'safe' string is required, e.g. kubernetes pod labels, directory names, etc.
     """
-    safe_chars = set(string.ascii_lowercase + string.digits)
     escaped_username = escapism.escape(
-        username, safe=safe_chars, escape_char="-"
+        username, safe=_escape_safe_chars, escape_char="-"
     ).lower()
     return escaped_username
 
@@ -50,158 +240,742 @@ def _escape_username_safe(username: str) -> str:
     return safe_slug(username, max_length=_slug_max_length)
 
 
+class SlugCache:
+    """
+    Bounded LRU cache of the escaped forms of usernames.
+
+    Both escaped forms of a username are computed once and reused across update cycles
+    and metrics, evicting the least recently used usernames beyond maxsize. When CPU-bound
+    work runs in a process pool, usernames are escaped in the main process and passed to
+    the workers, so that the cache and its metrics cover every lookup.
+    """
+
+    def __init__(self, maxsize: int = 100_000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._slugs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username: str) -> tuple[str, str]:
+        """
+        Return the escaped and safe forms of a username.
+        """
+        with self._lock:
+            slugs = self._slugs.get(username)
+            if slugs is not None:
+                self._slugs.move_to_end(username)
+                self.hits += 1
+                return slugs
+        slugs = (_escape_username(username), _escape_username_safe(username))
+        with self._lock:
+            self.misses += 1
+            self._slugs[username] = slugs
+            while len(self._slugs) > self.maxsize:
+                self._slugs.popitem(last=False)
+        return slugs
+
+    def get_many(self, usernames) -> dict:
+        """
+        Return the escaped and safe forms of each of the usernames.
+        """
+        return {username: self.get(username) for username in usernames}
+
+    def dump(self) -> dict:
+        """
+        Return a copy of the cached usernames and their escaped forms.
+        """
+        with self._lock:
+            return dict(self._slugs)
+
+    def load(self, slugs: dict):
+        """
+        Add usernames and their escaped forms, e.g. from a snapshot, to the cache.
+        """
+        with self._lock:
+            self._slugs.update(slugs)
+            while len(self._slugs) > self.maxsize:
+                self._slugs.popitem(last=False)
+
+    def collect(self):
+        """
+        Report cache hits, misses and size to Prometheus.
+        """
+        prefix = f"{metrics_namespace}_groups_exporter_slug_cache"
+        yield CounterMetricFamily(
+            f"{prefix}_hits", "Username slug cache hits.", value=self.hits
+        )
+        yield CounterMetricFamily(
+            f"{prefix}_misses", "Username slug cache misses.", value=self.misses
+        )
+        yield GaugeMetricFamily(
+            f"{prefix}_size", "Number of usernames in the slug cache.", len(self._slugs)
+        )
+
+
+SLUG_CACHE = SlugCache()
+REGISTRY.register(SLUG_CACHE)
+
+
+async def username_slugs(app: web.Application, usernames) -> dict | None:
+    """
+    Escape the usernames with the slug cache of this process if CPU-bound work runs in a
+    process pool, whose workers cannot use it, or return None to let the work use it.
+    """
+    if app["executor_kind"] != "process":
+        return None
+    return await run_blocking(app, SLUG_CACHE.get_many, usernames)
+
+
+def join_user_groups(user_index: dict, allowed_groups: frozenset) -> tuple[dict, set]:
+    """
+    Join users with their group memberships in a single pass over the user index.
+
+    Users with no allowed groups are mapped to the group 'none', and users in more
+    than one allowed group are additionally mapped to the group 'multiple'. If
+    allowed_groups is empty, all groups are allowed. Returns the user to groups
+    mapping and the set of users in multiple groups.
+    """
+    user_to_groups = {}
+    users_in_multiple_groups = set()
+    for user, groups in user_index.items():
+        if allowed_groups:
+            n_allowed = sum(1 for group in groups if group in allowed_groups)
+        else:
+            n_allowed = len(groups)
+        if n_allowed == 0:
+            user_to_groups[user] = ["none"]
+        elif n_allowed == 1:
+            user_to_groups[user] = list(groups)
+        else:
+            user_to_groups[user] = [*groups, "multiple"]
+            users_in_multiple_groups.add(user)
+    return user_to_groups, users_in_multiple_groups
+
+
+def _label_projection(labelnames: tuple) -> callable:
+    """
+    Return a function that picks the values of the given label names out of the full
+    label values of a series labelled by user.
+    """
+    if tuple(labelnames) == USER_LABELNAMES:
+        return lambda labelvalues: labelvalues
+    return itemgetter(*(USER_LABELNAMES.index(label) for label in labelnames))
+
+
+def user_group_info_samples(
+    user_index: dict,
+    allowed_groups: frozenset,
+    namespace: str,
+    double_count: bool,
+    labelnames: tuple,
+    slugs: dict = None,
+) -> tuple[dict, dict]:
+    """
+    Join users with their groups and build the samples of the user_group_info metric.
+
+    Usernames are escaped with the slugs from username_slugs, if given, or the slug cache.
+    Returns the user to groups mapping and the samples, keyed by the values of labelnames.
+    """
+    project = _label_projection(labelnames)
+    user_to_groups, users_in_multiple_groups = join_user_groups(
+        user_index, allowed_groups
+    )
+    logger.debug(f"Users in multiple groups: {users_in_multiple_groups}")
+    logger.debug(f"User to groups mapping: {user_to_groups}")
+    samples = {}
+    for user, groups in user_to_groups.items():
+        if user in users_in_multiple_groups:
+            logger.info(
+                f"User {user} is in multiple groups: assigning to default group 'multiple'."
+            )
+            if double_count == False:
+                groups = ["multiple"]
+        if slugs is not None:
+            username_escaped, username_safe = slugs[user]
+        else:
+            username_escaped, username_safe = SLUG_CACHE.get(user)
+        for group in groups:
+            labelvalues = (
+                f"{namespace}",
+                f"{group}",
+                f"{user}",
+                username_escaped,
+                username_safe,
+            )
+            samples[project(labelvalues)] = 1
+            logger.info(f"User {user} is in group {group}.")
+    return user_to_groups, samples
+
+
 async def update_user_group_info(
     app: web.Application,
     config: dict = None,
 ):
     """
     Update the prometheus exporter with user group memberships fetched from the JupyterHub API.
+
+    Every full_resync_cycles cycles, all users are crawled from the users API. In the cycles
+    in between, group memberships are rebuilt from the membership lists of the groups API,
+    and only users created since the last crawl are fetched from the users API. Users
+    deleted from the Hub are dropped at the next full resync. Membership events posted
+    while the crawl is running are applied on top of its results.
     """
     logger.info("This is the update_user_group_info coroutine.")
-    session = app["session"]
+    crawled = time.time()
+    session = app["hub_session"]
     hub_url = app["hub_url"]
-    allowed_groups = app["allowed_groups"]
-    double_count = app["double_count"]
-    namespace = app["namespace"]
-    endpoints = ["hub/api/users", "hub/api/groups"]
-    results = []
-    for i in range(len(endpoints)):
-        endpoint = endpoints[i]
-        data = await fetch_page(session, hub_url, endpoint)
-        if "_pagination" in data:
-            logger.debug(f"Received paginated data: {data['_pagination']}")
-            items = data["items"]
-            next_info = data["_pagination"]["next"]
-            while next_info:
-                data = await fetch_page(session, next_info["url"])
-                next_info = data["_pagination"]["next"]
-                items.extend(data["items"])
-        else:
-            logger.debug("Received non-paginated data.")
-            items = data
-        results.extend(items)
+    allowed_groups = frozenset(app["allowed_groups"])
+    semaphore = asyncio.Semaphore(app["hub_api_concurrency"])
+    cycle = app.get("user_group_cycle", 0)
+    app["membership_events"].clear()
+    full_resync = "user_index" not in app or cycle % app["full_resync_cycles"] == 0
+    if full_resync:
+        logger.info("Fetching all users for a full resync of user_group_map.")
+        user_index = {}
+    else:
+        logger.info("Fetching group memberships and new users for user_group_map.")
+        user_index = dict.fromkeys(app["user_index"], ())
+    n_users = 0
     list_groups = []
-    list_users = []
-    for r in results:
-        if r["kind"] == "group" and (
-            r["name"] in allowed_groups or allowed_groups == []
-        ):
-            list_groups.append(r["name"])
-        elif r["kind"] == "user":
-            for group in r["groups"]:
-                if group in allowed_groups or allowed_groups == []:
-                    list_users.append(r["name"])
-    user_counts = Counter(list_users)
-    users_in_multiple_groups = [
-        user for user, count in user_counts.items() if count > 1
-    ]
-    unique_users = list(set(list_users))
+
+    def fold_users(items: list):
+        nonlocal n_users
+        n_users += len(items)
+        for r in items:
+            if full_resync:
+                user_index[r["name"]] = tuple(r["groups"])
+            else:
+                user_index.setdefault(r["name"], ())
+
+    def fold_groups(items: list):
+        for r in items:
+            if not allowed_groups or r["name"] in allowed_groups:
+                list_groups.append(r["name"])
+            if full_resync:
+                continue
+            if "users" not in r:
+                raise ValueError(
+                    "Incremental updates need group memberships from the groups API, check that the service has the read:groups scope."
+                )
+            for user in r["users"]:
+                user_index[user] = user_index.get(user, ()) + (r["name"],)
+
+    async def consume(path: str, fold: callable, params: dict = None):
+        pages = iter_pages(
+            session,
+            hub_url,
+            path,
+            semaphore,
+            params,
+            app["hub_policy"],
+            hub_loads(app["json_decoder"]),
+        )
+        async with aclosing(pages):
+            async for items in pages:
+                fold(items)
+
+    if full_resync:
+        crawl_users = consume("hub/api/users", fold_users)
+    else:
+        crawl_users = crawl_new_users(
+            session,
+            hub_url,
+            semaphore,
+            frozenset(app["user_index"]),
+            app["hub_users_total"],
+            fold_users,
+            app["hub_policy"],
+            hub_loads(app["json_decoder"]),
+        )
+    n_total, _ = await gather_or_cancel(
+        crawl_users, consume("hub/api/groups", fold_groups)
+    )
     logger.debug(f"List groups: {list_groups}")
-    logger.debug(f"List users: {list_users}")
-    logger.debug(f"Users in multiple groups: {users_in_multiple_groups}")
     logger.info(
-        f"Updating {len(list_groups)} groups and {len(unique_users)} users for metric user_group_info."
+        f"Updating {len(list_groups)} groups and {len(user_index)} users for metric user_group_info."
     )
-    user_to_groups = {}
-    for r in results:
-        user = r["name"]
-        if r["kind"] == "user" and user in unique_users:
-            if r["groups"] != []:
-                for group in r["groups"]:
-                    user_to_groups.setdefault(user, []).append(group)
-        elif r["kind"] == "user":
-            logger.debug(f"User {user} has no groups.")
-            user_to_groups.setdefault(user, ["none"])
-    logger.debug(f"User to groups mapping: {user_to_groups}")
-    # Loop over users to export
-    USER_GROUP.clear()
-    for user in list(user_to_groups.keys()):
-        if user in users_in_multiple_groups:
-            user_to_groups[user].append("multiple")
-            USER_GROUP.labels(
-                namespace=f"{namespace}",
-                usergroup="multiple",
-                username=f"{user}",
-                username_escaped=_escape_username(user),
-                username_safe=_escape_username_safe(user),
-            ).set(1)
-            logger.info(
-                f"User {user} is in multiple groups: assigning to default group 'multiple'."
-            )
-            if double_count == False:
-                continue
-        for group in user_to_groups[user]:
-            USER_GROUP.labels(
-                namespace=f"{namespace}",
-                usergroup=f"{group}",
-                username=f"{user}",
-                username_escaped=_escape_username(user),
-                username_safe=_escape_username_safe(user),
-            ).set(1)
-            logger.info(f"User {user} is in group {group}.")
+    async with app["user_group_lock"]:
+        # Membership events received during the crawl may not be reflected by the Hub
+        apply_membership_events(user_index, app["membership_events"])
+        app["membership_events"].clear()
+        await set_user_group_info(app, user_index)
+        if app["snapshot_path"] or app["shared_state"] is not None:
+            await save_user_group_snapshot(app, user_index, crawled)
+    app["hub_users_total"] = n_users if full_resync else n_total
+    app["user_group_cycle"] = cycle + 1
+    return len(user_index)
+
+
+async def set_user_group_info(app: web.Application, user_index: dict):
+    """
+    Join the user index with groups and export it as the user_group_info metric.
+
+    Callers must hold app["user_group_lock"], so that the exported memberships always
+    match app["user_index"].
+    """
+    user_to_groups, samples = await run_cpu_bound(
+        app,
+        user_group_info_samples,
+        user_index,
+        frozenset(app["allowed_groups"]),
+        app["namespace"],
+        app["double_count"],
+        USER_GROUP.labelnames,
+        await username_slugs(app, user_index),
+    )
+    await run_blocking(app, USER_GROUP.set_samples, samples)
     app["user_group_map"] = user_to_groups
+    app["user_index"] = user_index
 
 
-async def update_group_usage(app: web.Application, config: dict):
+async def save_user_group_snapshot(
+    app: web.Application, user_index: dict, crawled: float = None
+):
     """
-    Attach user and group labels for metrics used to populate the User Group Diagnostics dashboard.
+    Write a snapshot of the user index and username slugs to the snapshot file and publish
+    it to the shared state of the replicas, if they are configured and it has changed.
+
+    crawled is the time of the crawl of the JupyterHub API that the user index comes from,
+    or None if it is the index of the last crawl updated by membership events. The time of
+    the last crawl is recorded even if the snapshot is unchanged, as the modification time
+    of the file and as the user_index_crawled blob of the shared state, so that a restarted
+    replica knows when the next crawl is due.
+
+    Callers must hold app["user_group_lock"], so that snapshots are saved in order.
     """
-    logger.info("This is the update_group_usage coroutine.")
-    if not app.get("user_group_map"):
-        logger.info("Doing nothing pending initialization of user_group_map.")
-        return
-    namespace = app["namespace"]
-    prometheus_host = app["prometheus_host"]
-    prometheus_port = app["prometheus_port"]
-    update_metrics_interval = app["update_metrics_interval"]
-    user_group_map = app["user_group_map"]
-    logger.debug(f"User group map: {user_group_map}")
+    if crawled is not None:
+        app["user_index_crawled"] = crawled
+    last_crawled = app.get("user_index_crawled", time.time())
+    etag, data = await run_blocking(
+        app,
+        encode_snapshot,
+        app["namespace"],
+        user_index,
+        SLUG_CACHE.dump(),
+        app.get("snapshot_etag"),
+    )
+    if data is None:
+        logger.debug("User group index unchanged, not saving a snapshot.")
+        if app["snapshot_path"] and crawled is not None:
+            try:
+                await run_blocking(
+                    app, touch_snapshot, app["snapshot_path"], last_crawled
+                )
+            except OSError as e:
+                logger.error(f"Error touching snapshot {app['snapshot_path']}: {e}")
+    else:
+        if app["snapshot_path"]:
+            try:
+                await run_blocking(
+                    app, write_snapshot, app["snapshot_path"], data, last_crawled
+                )
+                logger.info(
+                    f"Wrote snapshot of {len(user_index)} users to {app['snapshot_path']}."
+                )
+            except OSError as e:
+                logger.error(f"Error writing snapshot to {app['snapshot_path']}: {e}")
+        if app["shared_state"] is not None:
+            try:
+                await run_blocking(app, app["shared_state"].publish, "user_index", data)
+            except sqlite3.Error as e:
+                logger.error(f"Error publishing user group index to shared state: {e}")
+        app["snapshot_etag"] = etag
+    if app["shared_state"] is not None and crawled is not None:
+        try:
+            await run_blocking(
+                app,
+                app["shared_state"].publish,
+                "user_index_crawled",
+                str(crawled).encode(),
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Error publishing crawl time to shared state: {e}")
+
+
+MEMBERSHIP_EVENT_OPS = ("add", "remove", "set", "delete")
+
+
+def parse_membership_events(data) -> list:
+    """
+    Validate a membership event, or a list of them, posted to the exporter.
+
+    Events are objects with a "user" and an "op": "add" or "remove" a "group", "set" the
+    list of "groups" of the user, or "delete" the user. Raises ValueError if any event
+    is malformed.
+    """
+    events = data if isinstance(data, list) else [data]
+    for event in events:
+        if not isinstance(event, dict) or not isinstance(event.get("user"), str):
+            raise ValueError(f"Membership event {event!r} must have a user.")
+        op = event.get("op")
+        if op not in MEMBERSHIP_EVENT_OPS:
+            raise ValueError(
+                f"Membership event op {op!r} must be one of {MEMBERSHIP_EVENT_OPS}."
+            )
+        if op in ("add", "remove") and not isinstance(event.get("group"), str):
+            raise ValueError(f"Membership event {event!r} must have a group.")
+        if op == "set" and not (
+            isinstance(event.get("groups"), list)
+            and all(isinstance(group, str) for group in event["groups"])
+        ):
+            raise ValueError(f"Membership event {event!r} must have a list of groups.")
+    return events
+
+
+def apply_membership_events(user_index: dict, events: list):
+    """
+    Apply membership events, in order, to a user index of usernames to groups.
+    """
+    for event in events:
+        user = event["user"]
+        op = event["op"]
+        if op == "delete":
+            user_index.pop(user, None)
+        elif op == "set":
+            user_index[user] = tuple(dict.fromkeys(event["groups"]))
+        elif op == "add":
+            groups = user_index.get(user, ())
+            if event["group"] not in groups:
+                groups += (event["group"],)
+            user_index[user] = groups
+        elif op == "remove":
+            groups = user_index.get(user, ())
+            user_index[user] = tuple(
+                group for group in groups if group != event["group"]
+            )
+
+
+def _sample_value(result: dict, usage_aggregation: str) -> float:
+    """
+    Get the value to export from an instant vector or range vector Prometheus result.
+    """
+    if "value" in result:
+        return float(result["value"][-1])
+    values = [float(v) for _, v in result["values"]]
+    if usage_aggregation == "avg":
+        return sum(values) / len(values)
+    elif usage_aggregation == "max":
+        return max(values)
+    return values[-1]
+
+
+def _reduce_result(usage_aggregation: str, obj: dict):
+    """
+    JSON object hook that reduces each Prometheus result to a (username, value) pair.
+
+    The hook runs as soon as each result has been decoded, so its labels and range of
+    values are dropped straight away instead of being kept for the whole response.
+    """
+    if "metric" in obj and ("value" in obj or "values" in obj):
+        return obj["metric"]["username"], _sample_value(obj, usage_aggregation)
+    return obj
+
+
+def _reduce_results(usage_aggregation: str, data: dict) -> dict:
+    """
+    Reduce each result of a decoded Prometheus response to a (username, value) pair.
+    """
+    if data.get("status") == "success":
+        data["data"]["result"] = [
+            (result["metric"]["username"], _sample_value(result, usage_aggregation))
+            for result in data["data"]["result"]
+        ]
+    return data
+
+
+def _orjson_prometheus_loads(usage_aggregation: str, body: str) -> dict:
+    return _reduce_results(usage_aggregation, orjson.loads(body))
+
+
+def hub_loads(decoder: str) -> callable:
+    """
+    Get the function decoding the JSON responses of the JupyterHub API with the decoder.
+    """
+    if decoder == "orjson":
+        return orjson.loads
+    return json.loads
+
+
+def prometheus_loads(decoder: str, usage_aggregation: str) -> callable:
+    """
+    Get the function decoding a Prometheus response with the decoder, reducing each result
+    to a (username, value) pair.
+
+    The stdlib decoder reduces each result with an object hook as soon as it is decoded.
+    orjson has no object hook, so it builds the whole response before reducing it, but
+    decodes it several times faster.
+    """
+    if decoder == "orjson":
+        return partial(_orjson_prometheus_loads, usage_aggregation)
+    return partial(json.loads, object_hook=partial(_reduce_result, usage_aggregation))
+
+
+def _usage_labels(
+    username: str, user_group_map: dict, namespace: str, slugs: dict = None
+) -> list:
+    """
+    Build the label values of the usage series of a user, one for each of their groups.
+    """
+    groups = user_group_map.get(username, [])
+    if not groups:
+        logger.debug(f"User {username} has no groups, assigning to 'none'.")
+        groups = ["none"]
+    if slugs is not None:
+        username_escaped, username_safe = slugs[username]
+    else:
+        username_escaped, username_safe = SLUG_CACHE.get(username)
+    return [
+        (f"{namespace}", f"{group}", f"{username}", username_escaped, username_safe)
+        for group in groups
+    ]
+
+
+def group_usage_samples(
+    results: list,
+    user_group_map: dict,
+    namespace: str,
+    labelnames: list,
+    slugs: dict = None,
+) -> list:
+    """
+    Join the (username, value) results of several Prometheus usage queries with user groups.
+
+    The label values of each user are built once and shared by all usage metrics, with
+    usernames escaped with the slugs from username_slugs, if given, or the slug cache.
+    Returns the samples of each usage metric, keyed by the values of its labelnames, in
+    the same order as the query results.
+    """
+    labels_by_user = {}
+    samples = []
+    for result, metric_labelnames in zip(results, labelnames):
+        project = _label_projection(metric_labelnames)
+        metric_samples = {}
+        for username, value in result:
+            user_labels = labels_by_user.get(username)
+            if user_labels is None:
+                user_labels = _usage_labels(username, user_group_map, namespace, slugs)
+                labels_by_user[username] = user_labels
+            for labelvalues in user_labels:
+                metric_samples[project(labelvalues)] = value
+        samples.append(metric_samples)
+    return samples
+
+
+GROUP_QUANTILES = (0.5, 0.9, 0.99)
+
+
+def _quantile(sorted_values: list, quantile: float) -> float:
+    """
+    Linearly interpolated quantile of a non-empty sorted list of values.
+    """
+    position = quantile * (len(sorted_values) - 1)
+    lower = math.floor(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    fraction = position - lower
+    return (
+        sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * fraction
+    )
+
+
+def group_usage_aggregates(samples: list) -> list:
+    """
+    Aggregate the per-user samples of each usage metric into per-group counts, sums and quantiles.
+
+    Returns the aggregates of each usage metric, keyed by (namespace, usergroup) label values.
+    """
+    aggregates = []
+    for metric_samples in samples:
+        values_by_group = {}
+        for (namespace, usergroup, *_), value in metric_samples.items():
+            values_by_group.setdefault((namespace, usergroup), []).append(value)
+        metric_aggregates = {}
+        for group_labels, values in values_by_group.items():
+            values.sort()
+            metric_aggregates[group_labels] = (
+                len(values),
+                math.fsum(values),
+                tuple((q, _quantile(values, q)) for q in GROUP_QUANTILES),
+            )
+        aggregates.append(metric_aggregates)
+    return aggregates
+
+
+async def query_prometheus(
+    app: web.Application, name: str, query: str, to_date: datetime, step: int
+) -> list:
+    """
+    Evaluate a PromQL query at to_date, or over the update interval ending at to_date when
+    usage is aggregated over the interval, and return its results as (username, value) pairs.
+
+    The duration, results and errors of the query are recorded under its name, for each
+    shard of the query.
+    """
+    current_query.set(name)
+    start = time.perf_counter()
+    try:
+        results = await _query_prometheus(app, query, to_date, step)
+    except Exception as e:
+        QUERY_ERRORS.labels(name, type(e).__name__).inc()
+        raise
+    QUERY_DURATION.labels(name).observe(time.perf_counter() - start)
+    QUERY_RESULTS.labels(name).inc(len(results))
+    return results
+
+
+async def _query_prometheus(
+    app: web.Application, query: str, to_date: datetime, step: int
+) -> list:
     prometheus_api = URL.build(
-        scheme="http", host=prometheus_host, port=prometheus_port
+        scheme="http", host=app["prometheus_host"], port=app["prometheus_port"]
     )
-    query = config["query"].replace('namespace=~".*"', f'namespace="{namespace}"')
-    from_date = datetime.utcnow() - timedelta(seconds=update_metrics_interval)
-    to_date = datetime.utcnow()
-    step = str(config["update_interval"]) + "s"
-    parameters = {
-        "query": query,
-        "start": from_date.isoformat() + "Z",
-        "end": to_date.isoformat() + "Z",
-        "step": step,
-    }
+    query = query.replace('namespace=~".*"', f'namespace="{app["namespace"]}"')
+    if app["usage_aggregation"] == "last":
+        # Only the latest sample is exported, so evaluate the query at a single instant
+        path = "api/v1/query"
+        parameters = {
+            "query": query,
+            "time": to_date.isoformat() + "Z",
+        }
+    else:
+        path = "api/v1/query_range"
+        from_date = to_date - timedelta(seconds=app["update_metrics_interval"])
+        parameters = {
+            "query": query,
+            "start": from_date.isoformat() + "Z",
+            "end": to_date.isoformat() + "Z",
+            "step": f"{step}s",
+        }
     logger.debug(f"Prometheus query parameters: {parameters}")
     data = await fetch_page(
-        session=app["session"],
+        session=app["prometheus_session"],
         url=prometheus_api,
-        path="api/v1/query_range",
+        path=path,
         params=parameters,
+        loads=prometheus_loads(app["json_decoder"], app["usage_aggregation"]),
+        policy=app["prometheus_policy"],
     )
     if data["status"] != "success":
         raise aiohttp.ClientError(f"Bad response from Prometheus: {data}")
     results = data["data"]["result"]
     logger.debug(f"Prometheus results: {results}")
-    joined = []
-    for r in results:
-        username = r["metric"]["username"]
-        groups = user_group_map.get(username, [])
-        if not groups:
-            r_copy = copy.deepcopy(r)
-            r_copy["metric"]["usergroup"] = "none"
-            joined.append(r_copy)
-            logger.debug(f"User {username} has no groups, assigning to 'none'.")
-        else:
-            for group in groups:
-                r_copy = copy.deepcopy(r)
-                r_copy["metric"]["usergroup"] = group
-                joined.append(r_copy)
-    logger.debug(f"Joined metrics: {joined}")
-    # Export joined metrics
-    config["metric"].clear()
-    for j in joined:
-        config["metric"].labels(
-            namespace=f"{namespace}",
-            username=f"{j['metric']['username']}",
-            username_escaped=_escape_username(j["metric"]["username"]),
-            username_safe=_escape_username_safe(j["metric"]["username"]),
-            usergroup=f"{j['metric']['usergroup']}",
-        ).set(float(j["values"][-1][-1]))
+    return results
+
+
+USERNAME_SHARD_ALPHABET = string.ascii_lowercase + string.digits
+
+
+def username_shard_patterns(shards: int) -> list:
+    """
+    Partition usernames into regular expressions matching their first character.
+
+    The first characters of the alphabet are split between the shards, up to one per
+    character. The last shard also matches usernames starting with any character outside
+    of the alphabet, so that every username is matched by exactly one pattern.
+    """
+    shards = min(shards, len(USERNAME_SHARD_ALPHABET))
+    if shards <= 1:
+        return [".*"]
+    n = len(USERNAME_SHARD_ALPHABET)
+    chunks = [
+        USERNAME_SHARD_ALPHABET[n * i // shards : n * (i + 1) // shards]
+        for i in range(shards - 1)
+    ]
+    return [f"[{chunk}].*" for chunk in chunks] + [f"[^{''.join(chunks)}].*"]
+
+
+def shard_query(query: dict, pattern: str) -> str:
+    """
+    Restrict a usage query to the users whose shard label matches the pattern.
+    """
+    if pattern == ".*":
+        return query["query"]
+    label = query["shard_label"]
+    return query["query"].replace(f'{label}=~".*"', f'{label}=~"{pattern}"')
+
+
+async def update_group_usage(app: web.Application, config: dict):
+    """
+    Attach user and group labels for metrics used to populate the User Group Diagnostics dashboard.
+
+    All queries in the config are evaluated concurrently at the same timestamp. Each query
+    can be split into shards of users, which are all fetched concurrently and joined with
+    user groups shard by shard as they arrive, so that no response holds every user. The
+    results of the queries of a shard are joined in a single pass. A metric whose query
+    fails, in any shard, keeps its previous values.
+    """
+    logger.info("This is the update_group_usage coroutine.")
+    if not app.get("user_group_map"):
+        logger.info("Doing nothing pending initialization of user_group_map.")
+        return 0
+    user_group_map = app["user_group_map"]
+    logger.debug(f"User group map: {user_group_map}")
+    to_date = datetime.utcnow()
+    queries = config["queries"]
+
+    async def query_shard(pattern: str) -> list:
+        return await asyncio.gather(
+            *(
+                query_prometheus(
+                    app,
+                    q["name"],
+                    shard_query(q, pattern),
+                    to_date,
+                    config["update_interval"],
+                )
+                for q in queries
+            ),
+            return_exceptions=True,
+        )
+
+    shards = [
+        asyncio.create_task(query_shard(pattern))
+        for pattern in username_shard_patterns(app["query_shards"])
+    ]
+    failed = set()
+    samples = [{} for _ in queries]
+    n_results = 0
+    try:
+        for next_shard in asyncio.as_completed(shards):
+            responses = await next_shard
+            joined = []
+            for i, (q, response) in enumerate(zip(queries, responses)):
+                if isinstance(response, Exception):
+                    logger.error(
+                        f"Error querying Prometheus for {q['name']} usage: {response}"
+                    )
+                    failed.add(i)
+                elif i not in failed:
+                    joined.append(i)
+            results = [responses[i] for i in joined]
+            slugs = await username_slugs(
+                app, {username for result in results for username, _ in result}
+            )
+            shard_samples = await run_cpu_bound(
+                app,
+                group_usage_samples,
+                results,
+                user_group_map,
+                app["namespace"],
+                [queries[i]["metric"].labelnames for i in joined],
+                slugs,
+            )
+            for i, metric_samples in zip(joined, shard_samples):
+                samples[i].update(metric_samples)
+                n_results += len(responses[i])
+    finally:
+        # Cancel the other shards if the update is cancelled
+        await cancel_tasks(shards)
+    updated = [i for i in range(len(queries)) if i not in failed]
+    samples = [samples[i] for i in updated]
+    queries = [queries[i] for i in updated]
+    if app["group_aggregates"]:
+        aggregates = await run_cpu_bound(app, group_usage_aggregates, samples)
+        for q, metric_aggregates in zip(queries, aggregates):
+            q["summary"].set(metric_aggregates)
+    for q, metric_samples in zip(queries, samples):
+        if not app["per_user_series"]:
+            metric_samples = {}
+        await run_blocking(app, q["metric"].set_samples, metric_samples)
+        QUERY_LAST_SUCCESS.labels(q["name"]).set_to_current_time()
+    return n_results
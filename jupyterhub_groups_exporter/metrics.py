@@ -1,12 +1,91 @@
 import os
+import sys
+from array import array
 
-from prometheus_client import Gauge
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    Metric,
+)
+from prometheus_client.core import GaugeMetricFamily
 
 # Define Prometheus metrics
 
 namespace = os.environ.get("JUPYTERHUB_METRICS_PREFIX", "jupyterhub")
 
-USER_GROUP = Gauge(
+
+class _Series:
+    """
+    Columnar storage of the series of a UserGroupGauge.
+    """
+
+    __slots__ = ("labelvalues", "values")
+
+    def __init__(self, labelvalues: tuple = (), values: array = None):
+        self.labelvalues = labelvalues
+        self.values = array("d") if values is None else values
+
+
+class UserGroupGauge:
+    """
+    Collector of a gauge labelled by user and group, backed by compact columnar storage.
+
+    A labelled prometheus_client Gauge allocates a child with its own lock and value object
+    for every series. Here the series are kept as a tuple of label value tuples, made of
+    interned strings shared by all gauges, and an array of float values. Both are replaced
+    at once by set_samples, so a collection always sees a complete set of series.
+    """
+
+    __slots__ = ("name", "documentation", "labelnames", "_series")
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: list,
+        namespace: str,
+        registry: CollectorRegistry = REGISTRY,
+    ):
+        self.name = f"{namespace}_{name}"
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = _Series()
+        if registry is not None:
+            registry.register(self)
+
+    def __len__(self) -> int:
+        return len(self._series.values)
+
+    def set_samples(self, samples: dict):
+        """
+        Replace all series with the samples, keyed by tuples of label values in the order
+        of labelnames.
+
+        The label value tuples of series that were already set are reused, so that only
+        the label values of new series are interned and allocated on each update.
+        """
+        intern = sys.intern
+        previous = self._series.labelvalues
+        existing = dict(zip(previous, previous))
+        labelvalues = tuple(
+            existing.get(lv) or tuple(map(intern, lv)) for lv in samples
+        )
+        self._series = _Series(labelvalues, array("d", samples.values()))
+
+    def collect(self):
+        series = self._series
+        family = GaugeMetricFamily(
+            self.name, self.documentation, labels=self.labelnames
+        )
+        for labelvalues, value in zip(series.labelvalues, series.values):
+            family.add_metric(labelvalues, value)
+        yield family
+
+
+USER_GROUP = UserGroupGauge(
     "user_group_info",
     "JupyterHub namespace, username and user group membership information.",
     [
@@ -19,7 +98,7 @@ USER_GROUP = Gauge(
     namespace=namespace,
 )
 
-GROUP_USAGE_MEMORY = Gauge(
+GROUP_USAGE_MEMORY = UserGroupGauge(
     "user_group_memory_bytes",
     "Working memory set usage in bytes by user and group.",
     [
@@ -32,7 +111,7 @@ GROUP_USAGE_MEMORY = Gauge(
     namespace=namespace,
 )
 
-GROUP_USAGE_COMPUTE = Gauge(
+GROUP_USAGE_COMPUTE = UserGroupGauge(
     "user_group_cpu_seconds",
     "CPU usage in core seconds by user and group.",
     [
@@ -46,7 +125,7 @@ GROUP_USAGE_COMPUTE = Gauge(
 )
 
 
-GROUP_REQUESTS_MEMORY = Gauge(
+GROUP_REQUESTS_MEMORY = UserGroupGauge(
     "user_group_memory_requests_bytes",
     "Memory requests in bytes by user and group.",
     [
@@ -60,7 +139,7 @@ GROUP_REQUESTS_MEMORY = Gauge(
 )
 
 
-GROUP_REQUESTS_COMPUTE = Gauge(
+GROUP_REQUESTS_COMPUTE = UserGroupGauge(
     "user_group_cpu_requests_seconds",
     "CPU requests in core seconds by user and group.",
     [
@@ -74,7 +153,7 @@ GROUP_REQUESTS_COMPUTE = Gauge(
 )
 
 
-GROUP_HOME_DIR = Gauge(
+GROUP_HOME_DIR = UserGroupGauge(
     "user_group_home_dir_bytes",
     "Home directory usage in bytes by user and group.",
     [
@@ -87,6 +166,265 @@ GROUP_HOME_DIR = Gauge(
     namespace=namespace,
 )
 
+USERNAME_LABELS = ["username", "username_escaped", "username_safe"]
+
+# Full label names of the gauges labelled by user, before any are dropped
+USER_LABELNAMES = ("namespace", "usergroup", *USERNAME_LABELS)
+
+# Gauges labelled by user, keyed by metric name without the prefix
+USER_GAUGES = {
+    "user_group_info": USER_GROUP,
+    "user_group_memory_bytes": GROUP_USAGE_MEMORY,
+    "user_group_cpu_seconds": GROUP_USAGE_COMPUTE,
+    "user_group_memory_requests_bytes": GROUP_REQUESTS_MEMORY,
+    "user_group_cpu_requests_seconds": GROUP_REQUESTS_COMPUTE,
+    "user_group_home_dir_bytes": GROUP_HOME_DIR,
+}
+
+
+def set_username_labels(gauge: UserGroupGauge, username_labels: list):
+    """
+    Restrict the username labels of a gauge labelled by user to the given variants.
+
+    This must be called before any series of the gauge is set.
+    """
+    if len(gauge):
+        raise RuntimeError(
+            f"Cannot change the labels of {gauge.name} once it has series."
+        )
+    gauge.labelnames = (
+        "namespace",
+        "usergroup",
+        *(label for label in USERNAME_LABELS if label in username_labels),
+    )
+
+
+class GroupUsageSummary:
+    """
+    Collector of the per-group aggregates of a usage metric, exported as a Prometheus summary.
+
+    The summary has a series per quantile and group, plus the sum and count of the usage
+    of the users in each group. Nothing is exported until aggregates are set.
+    """
+
+    def __init__(self, name: str, documentation: str, namespace: str):
+        self.name = f"{namespace}_{name}"
+        self.documentation = documentation
+        self._aggregates = {}
+        REGISTRY.register(self)
+
+    def set(self, aggregates: dict):
+        """
+        Replace the aggregates, a mapping of (namespace, usergroup) label values to
+        (count, sum, quantiles) tuples, where quantiles is a tuple of (quantile, value) pairs.
+        """
+        self._aggregates = aggregates
+
+    def collect(self):
+        aggregates = self._aggregates
+        if not aggregates:
+            return
+        metric = Metric(self.name, self.documentation, "summary")
+        for (namespace, usergroup), (count, total, quantiles) in aggregates.items():
+            labels = {"namespace": namespace, "usergroup": usergroup}
+            for quantile, value in quantiles:
+                metric.add_sample(
+                    self.name, {**labels, "quantile": str(quantile)}, value
+                )
+            metric.add_sample(f"{self.name}_sum", labels, total)
+            metric.add_sample(f"{self.name}_count", labels, count)
+        yield metric
+
+
+GROUP_USAGE_MEMORY_SUMMARY = GroupUsageSummary(
+    "user_group_memory_bytes_by_group",
+    "Working memory set usage in bytes of the users in each group.",
+    namespace=namespace,
+)
+
+GROUP_USAGE_COMPUTE_SUMMARY = GroupUsageSummary(
+    "user_group_cpu_seconds_by_group",
+    "CPU usage in core seconds of the users in each group.",
+    namespace=namespace,
+)
+
+GROUP_REQUESTS_MEMORY_SUMMARY = GroupUsageSummary(
+    "user_group_memory_requests_bytes_by_group",
+    "Memory requests in bytes of the users in each group.",
+    namespace=namespace,
+)
+
+GROUP_REQUESTS_COMPUTE_SUMMARY = GroupUsageSummary(
+    "user_group_cpu_requests_seconds_by_group",
+    "CPU requests in core seconds of the users in each group.",
+    namespace=namespace,
+)
+
+GROUP_HOME_DIR_SUMMARY = GroupUsageSummary(
+    "user_group_home_dir_bytes_by_group",
+    "Home directory usage in bytes of the users in each group.",
+    namespace=namespace,
+)
+
+EVENT_LOOP_LAG = Histogram(
+    "groups_exporter_event_loop_lag_seconds",
+    "Delay of the exporter's event loop in waking up a sleeping task in seconds.",
+    namespace=namespace,
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+
+HTTP_CONNECTIONS_CREATED = Counter(
+    "groups_exporter_http_connections_created",
+    "Number of new HTTP connections opened to each upstream.",
+    ["upstream"],
+    namespace=namespace,
+)
+
+HTTP_CONNECTIONS_REUSED = Counter(
+    "groups_exporter_http_connections_reused",
+    "Number of HTTP requests to each upstream that reused a kept-alive connection.",
+    ["upstream"],
+    namespace=namespace,
+)
+
+HTTP_POOL_WAIT = Histogram(
+    "groups_exporter_http_pool_wait_seconds",
+    "Time spent waiting for a free connection in the pool of each upstream in seconds.",
+    ["upstream"],
+    namespace=namespace,
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+
+HTTP_RETRIES = Counter(
+    "groups_exporter_http_retries",
+    "Number of failed requests to each upstream that were retried.",
+    ["upstream"],
+    namespace=namespace,
+)
+
+HTTP_RETRY_BUDGET_EXHAUSTED = Counter(
+    "groups_exporter_http_retry_budget_exhausted",
+    "Number of failed requests to each upstream not retried because the retry budget was spent.",
+    ["upstream"],
+    namespace=namespace,
+)
+
+CIRCUIT_BREAKER_OPEN = Gauge(
+    "groups_exporter_circuit_breaker_open",
+    "Whether the circuit breaker of each upstream is open, failing requests without sending them.",
+    ["upstream"],
+    namespace=namespace,
+)
+
+UPDATE_DEADLINE_EXCEEDED = Counter(
+    "groups_exporter_update_deadline_exceeded",
+    "Number of update cycles cancelled for running up to their next cycle.",
+    ["update"],
+    namespace=namespace,
+)
+
+UPDATE_CYCLES_SKIPPED = Counter(
+    "groups_exporter_update_cycles_skipped",
+    "Number of update cycles skipped because the previous cycle ran past their start time.",
+    ["update"],
+    namespace=namespace,
+)
+
+UPDATE_BUCKETS = (
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+    600.0,
+)
+
+UPDATE_LAST_SUCCESS = Gauge(
+    "groups_exporter_update_last_success_timestamp_seconds",
+    "Unix time of the last successful cycle of each update.",
+    ["update"],
+    namespace=namespace,
+)
+
+UPDATE_DURATION = Histogram(
+    "groups_exporter_update_duration_seconds",
+    "Duration of the successful cycles of each update in seconds.",
+    ["update"],
+    namespace=namespace,
+    buckets=UPDATE_BUCKETS,
+)
+
+UPDATE_ITEMS = Counter(
+    "groups_exporter_update_items_processed",
+    "Number of users or query results processed by each update.",
+    ["update"],
+    namespace=namespace,
+)
+
+UPDATE_ERRORS = Counter(
+    "groups_exporter_update_errors",
+    "Number of failed cycles of each update by type of error.",
+    ["update", "error"],
+    namespace=namespace,
+)
+
+UPDATE_PAGES = Counter(
+    "groups_exporter_update_pages_fetched",
+    "Number of pages or query responses fetched by each update.",
+    ["update"],
+    namespace=namespace,
+)
+
+UPDATE_BYTES = Counter(
+    "groups_exporter_update_bytes_downloaded",
+    "Number of bytes of response bodies downloaded by each update, after decompression.",
+    ["update"],
+    namespace=namespace,
+)
+
+QUERY_LAST_SUCCESS = Gauge(
+    "groups_exporter_query_last_success_timestamp_seconds",
+    "Unix time of the last successful Prometheus query of each usage metric.",
+    ["query"],
+    namespace=namespace,
+)
+
+QUERY_DURATION = Histogram(
+    "groups_exporter_query_duration_seconds",
+    "Duration of the successful Prometheus queries of each usage metric in seconds.",
+    ["query"],
+    namespace=namespace,
+    buckets=UPDATE_BUCKETS,
+)
+
+QUERY_RESULTS = Counter(
+    "groups_exporter_query_results",
+    "Number of user results returned by the Prometheus queries of each usage metric.",
+    ["query"],
+    namespace=namespace,
+)
+
+QUERY_BYTES = Counter(
+    "groups_exporter_query_bytes_downloaded",
+    "Number of bytes of Prometheus responses downloaded for each usage metric, after decompression.",
+    ["query"],
+    namespace=namespace,
+)
+
+QUERY_ERRORS = Counter(
+    "groups_exporter_query_errors",
+    "Number of failed Prometheus queries of each usage metric by type of error.",
+    ["query", "error"],
+    namespace=namespace,
+)
+
 # Prometheus usage queries
 
 USAGE_MEMORY = """
@@ -152,31 +490,47 @@ HOME_DIR = """
 """
 
 # Config for Prometheus queries
+# The shard label of each query is matched against the username patterns of its shards
 
 
 CONFIG_COMPUTE = [
     {
+        "name": "memory",
         "query": USAGE_MEMORY,
+        "shard_label": "annotation_hub_jupyter_org_username",
         "metric": GROUP_USAGE_MEMORY,
+        "summary": GROUP_USAGE_MEMORY_SUMMARY,
     },
     {
+        "name": "cpu",
         "query": USAGE_COMPUTE,
+        "shard_label": "annotation_hub_jupyter_org_username",
         "metric": GROUP_USAGE_COMPUTE,
+        "summary": GROUP_USAGE_COMPUTE_SUMMARY,
     },
     {
+        "name": "memory_requests",
         "query": REQUESTS_MEMORY,
+        "shard_label": "annotation_hub_jupyter_org_username",
         "metric": GROUP_REQUESTS_MEMORY,
+        "summary": GROUP_REQUESTS_MEMORY_SUMMARY,
     },
     {
+        "name": "cpu_requests",
         "query": REQUESTS_COMPUTE,
+        "shard_label": "annotation_hub_jupyter_org_username",
         "metric": GROUP_REQUESTS_COMPUTE,
+        "summary": GROUP_REQUESTS_COMPUTE_SUMMARY,
     },
 ]
 
 
 CONFIG_DIRSIZE = [
     {
+        "name": "home_dir",
         "query": HOME_DIR,
+        "shard_label": "username_escaped",
         "metric": GROUP_HOME_DIR,
+        "summary": GROUP_HOME_DIR_SUMMARY,
     },
 ]
@@ -0,0 +1,158 @@
+"""
+Retry budgets and circuit breakers for requests to the JupyterHub API and Prometheus.
+"""
+
+import asyncio
+import logging
+import time
+
+import aiohttp
+import backoff
+
+from .metrics import CIRCUIT_BREAKER_OPEN, HTTP_RETRIES, HTTP_RETRY_BUDGET_EXHAUSTED
+from .scheduler import run_deadline
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(aiohttp.ClientError):
+    """
+    Raised instead of sending a request to an upstream whose circuit breaker is open.
+    """
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Whether a failed request may succeed if retried: connection errors, timeouts, server
+    errors and rate limiting, but not other client errors such as a missing scope.
+    """
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status == 429
+    return True
+
+
+class RetryBudget:
+    """
+    Token bucket that caps retries to a fraction of the requests made to an upstream.
+
+    Every request deposits ratio tokens and every retry withdraws one, so when an upstream
+    is failing the retries add at most ratio extra load on top of the requests themselves.
+    The bucket starts with, and holds at most, min_retries tokens so that occasional
+    failures can always be retried.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_retries: int = 10):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.tokens = float(min_retries)
+
+    def deposit(self):
+        self.tokens = min(self.tokens + self.ratio, self.min_retries)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class CircuitBreaker:
+    """
+    Fail requests to an upstream fast after failure_threshold consecutive failures.
+
+    The breaker stays open for reset_timeout seconds, after which requests are let through
+    again: a success closes the breaker, while a failure opens it for another reset_timeout.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return (
+            self.failures >= self.failure_threshold
+            and time.monotonic() - self.opened_at < self.reset_timeout
+        )
+
+    def record_success(self):
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class UpstreamPolicy:
+    """
+    Retry policy of the requests to an upstream, shared by all of its update loops.
+
+    Failed requests are retried up to max_retries times with exponential backoff and full
+    jitter, as long as the retry budget of the upstream allows it and its circuit breaker
+    is closed. Client errors other than rate limiting are raised without a retry, and do
+    not count towards opening the circuit breaker.
+
+    Within an update cycle with a deadline, every attempt but the last is given at most
+    half of the time left, and backoff sleeps at most a quarter of it, so that a slow or
+    failing upstream leaves time to retry before the cycle is cancelled.
+    """
+
+    def __init__(
+        self,
+        upstream: str,
+        max_retries: int = 5,
+        max_backoff: float = 30,
+        budget: RetryBudget = None,
+        breaker: CircuitBreaker = None,
+    ):
+        self.upstream = upstream
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.budget = budget or RetryBudget()
+        self.breaker = breaker or CircuitBreaker()
+        CIRCUIT_BREAKER_OPEN.labels(upstream).set_function(
+            lambda: float(self.breaker.is_open)
+        )
+
+    async def call(self, request: callable):
+        """
+        Await request(), retrying it on connection errors, timeouts, server errors and
+        rate limiting.
+        """
+        if self.breaker.is_open:
+            raise CircuitOpenError(f"Circuit breaker for {self.upstream} is open.")
+        self.budget.deposit()
+        delays = backoff.expo(max_value=self.max_backoff)
+        next(delays)
+        loop = asyncio.get_running_loop()
+        deadline = run_deadline.get()
+        for attempt in range(self.max_retries + 1):
+            timeout = None
+            if deadline is not None and attempt < self.max_retries:
+                timeout = max(deadline - loop.time(), 0) / 2
+            try:
+                async with asyncio.timeout(timeout):
+                    result = await request()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not is_retryable(e):
+                    raise
+                self.breaker.record_failure()
+                if attempt == self.max_retries or self.breaker.is_open:
+                    raise
+                if not self.budget.withdraw():
+                    HTTP_RETRY_BUDGET_EXHAUSTED.labels(self.upstream).inc()
+                    raise
+                delay = backoff.full_jitter(next(delays))
+                if deadline is not None:
+                    delay = min(delay, max(deadline - loop.time(), 0) / 4)
+                logger.info(
+                    f"Retrying request to {self.upstream} in {delay:.1f}s after {e!r}."
+                )
+                HTTP_RETRIES.labels(self.upstream).inc()
+                await asyncio.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return result
@@ -0,0 +1,106 @@
+"""
+Scheduler running the update jobs of the exporter on fixed-rate ticks.
+"""
+
+import asyncio
+import contextvars
+import logging
+import math
+
+from .metrics import UPDATE_CYCLES_SKIPPED
+
+logger = logging.getLogger(__name__)
+
+# Event loop time by which the current run must finish, so that its job is free at its
+# next tick. Runs started by the scheduler see the deadline of their own tick.
+run_deadline = contextvars.ContextVar("run_deadline", default=None)
+
+
+class Job:
+    """
+    A coroutine function run every interval seconds, starting phase seconds after the
+    scheduler starts.
+    """
+
+    def __init__(
+        self, name: str, interval: float, func: callable, args: tuple, phase: float
+    ):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.args = args
+        self.phase = phase
+        self.ticker = None
+        self.run = None
+
+
+class Scheduler:
+    """
+    Run jobs on fixed-rate ticks, keeping a handle on every task it starts.
+
+    Ticks are computed from the start time rather than by sleeping after each run, so
+    intervals do not drift by the duration of the runs. The first ticks of the jobs are
+    spread over the shortest interval in the order the jobs were added, so that they do
+    not all hit the JupyterHub API and Prometheus at once.
+
+    Each run gets a deadline, in run_deadline, a tenth of an interval before the next tick
+    of its job. A tick that comes while the previous run is still going, e.g. wrapping up
+    after its deadline, waits for it to finish, and the ticks missed in the meantime are
+    skipped.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.started_at = None
+
+    def add_job(
+        self, name: str, interval: float, func: callable, *args, phase: float = None
+    ):
+        """
+        Add a job, to start phase seconds after the scheduler starts if given, or in its
+        turn among the jobs without a phase otherwise.
+        """
+        self.jobs[name] = Job(name, interval, func, args, phase)
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self.started_at = loop.time()
+        spread = min(job.interval for job in self.jobs.values())
+        spread_jobs = [job for job in self.jobs.values() if job.phase is None]
+        for i, job in enumerate(spread_jobs):
+            job.phase = spread * i / len(spread_jobs)
+        for job in self.jobs.values():
+            job.ticker = asyncio.create_task(self._tick(job), name=f"tick-{job.name}")
+            logger.info(
+                f"Scheduled {job.name} every {job.interval}s, starting in {job.phase:.1f}s."
+            )
+
+    async def _tick(self, job: Job):
+        loop = asyncio.get_running_loop()
+        first_tick = self.started_at + job.phase
+        tick = 0
+        while True:
+            await asyncio.sleep(max(first_tick + tick * job.interval - loop.time(), 0))
+            if job.run is not None and not job.run.done():
+                logger.warning(f"Waiting for the previous run of {job.name} to finish.")
+                await asyncio.wait([job.run])
+            # Skip the ticks that were missed while the event loop was busy or the
+            # previous run was finishing
+            next_tick = math.floor((loop.time() - first_tick) / job.interval) + 1
+            run_deadline.set(first_tick + (next_tick - 0.1) * job.interval)
+            job.run = asyncio.create_task(job.func(*job.args), name=job.name)
+            if next_tick > tick + 1:
+                UPDATE_CYCLES_SKIPPED.labels(job.name).inc(next_tick - tick - 1)
+            tick = next_tick
+
+    async def stop(self):
+        """
+        Cancel the tickers and any runs in progress, and wait for them to finish.
+        """
+        tasks = []
+        for job in self.jobs.values():
+            tasks.extend(task for task in (job.ticker, job.run) if task is not None)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logger.info("Scheduler stopped.")
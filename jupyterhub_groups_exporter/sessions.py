@@ -0,0 +1,67 @@
+"""
+HTTP client sessions with a separate connection pool for each upstream.
+"""
+
+import asyncio
+
+import aiohttp
+
+from .metrics import HTTP_CONNECTIONS_CREATED, HTTP_CONNECTIONS_REUSED, HTTP_POOL_WAIT
+
+
+def _trace_config(upstream: str) -> aiohttp.TraceConfig:
+    """
+    Record connection reuse and the time spent waiting for a free connection in the pool.
+    """
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_connection_queued_start(session, context, params):
+        context.queued_at = asyncio.get_running_loop().time()
+
+    async def on_connection_queued_end(session, context, params):
+        HTTP_POOL_WAIT.labels(upstream).observe(
+            asyncio.get_running_loop().time() - context.queued_at
+        )
+
+    async def on_connection_create_end(session, context, params):
+        HTTP_CONNECTIONS_CREATED.labels(upstream).inc()
+
+    async def on_connection_reuseconn(session, context, params):
+        HTTP_CONNECTIONS_REUSED.labels(upstream).inc()
+
+    trace_config.on_connection_queued_start.append(on_connection_queued_start)
+    trace_config.on_connection_queued_end.append(on_connection_queued_end)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    return trace_config
+
+
+def make_session(
+    upstream: str,
+    connection_limit: int,
+    request_timeout: float,
+    connect_timeout: float,
+    keepalive_timeout: float,
+    dns_cache_ttl: int,
+    headers: dict = None,
+) -> aiohttp.ClientSession:
+    """
+    Create a client session with its own connection pool for a single upstream.
+
+    Each upstream is a single host, so the per-host limit is the pool size. Requests that
+    find the pool full wait for a connection to be released, which is bounded by the
+    connect timeout, while the request timeout bounds each request as a whole.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=connection_limit,
+        limit_per_host=connection_limit,
+        keepalive_timeout=keepalive_timeout,
+        ttl_dns_cache=dns_cache_ttl,
+    )
+    timeout = aiohttp.ClientTimeout(total=request_timeout, connect=connect_timeout)
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=timeout,
+        headers=headers,
+        trace_configs=[_trace_config(upstream)],
+    )
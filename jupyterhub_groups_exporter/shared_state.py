@@ -0,0 +1,134 @@
+"""
+Shared state of exporter replicas, so that one leader fetches and renders the metrics
+and the other replicas only serve them.
+"""
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+from contextlib import closing
+
+logger = logging.getLogger(__name__)
+
+
+class SharedState:
+    """
+    Leader lease, published blobs, such as the rendered metrics and the user group index,
+    and pending membership events of the replicas, stored in a SQLite database on a
+    volume they share.
+
+    The replica holding an unexpired lease is the leader. Lease expiry is compared with
+    the wall clock of each replica, so their clocks must be roughly in sync. Each method
+    opens its own connection, so they can be called from worker threads.
+    """
+
+    def __init__(self, path: str, lease_seconds: float, identity: str = None):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.identity = identity or f"{socket.gethostname()}-{os.getpid()}"
+        self.is_leader = False
+        with closing(self._connect()) as db:
+            db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS lease (
+                    name TEXT PRIMARY KEY, holder TEXT, expires REAL
+                );
+                CREATE TABLE IF NOT EXISTS blobs (
+                    name TEXT PRIMARY KEY, version INTEGER, data BLOB
+                );
+                CREATE TABLE IF NOT EXISTS membership_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, events TEXT
+                );
+                """
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        db.execute("PRAGMA busy_timeout = 10000")
+        return db
+
+    def acquire_lease(self) -> bool:
+        """
+        Take or renew the leader lease if it is free, expired or already ours, and return
+        whether this replica is the leader.
+        """
+        now = time.time()
+        with closing(self._connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT holder, expires FROM lease WHERE name = 'leader'"
+            ).fetchone()
+            is_leader = row is None or row[0] == self.identity or row[1] < now
+            if is_leader:
+                db.execute(
+                    "INSERT OR REPLACE INTO lease VALUES ('leader', ?, ?)",
+                    (self.identity, now + self.lease_seconds),
+                )
+            db.execute("COMMIT")
+        if is_leader != self.is_leader:
+            logger.info(
+                f"Replica {self.identity} is {'now' if is_leader else 'no longer'} the leader."
+            )
+        self.is_leader = is_leader
+        return is_leader
+
+    def release_lease(self):
+        """
+        Give up the leader lease, if we hold it, so that another replica can take over.
+        """
+        with closing(self._connect()) as db:
+            db.execute(
+                "DELETE FROM lease WHERE name = 'leader' AND holder = ?",
+                (self.identity,),
+            )
+        self.is_leader = False
+
+    def publish(self, name: str, data: bytes):
+        """
+        Store a new version of the named blob, e.g. the rendered metrics.
+        """
+        with closing(self._connect()) as db:
+            db.execute(
+                """
+                INSERT INTO blobs VALUES (?, 1, ?)
+                ON CONFLICT (name) DO UPDATE SET version = version + 1, data = excluded.data
+                """,
+                (name, data),
+            )
+
+    def fetch(self, name: str, since_version: int = 0) -> tuple[int, bytes] | None:
+        """
+        Return the version and data of the named blob if it is newer than since_version.
+        """
+        with closing(self._connect()) as db:
+            row = db.execute(
+                "SELECT version, data FROM blobs WHERE name = ? AND version > ?",
+                (name, since_version),
+            ).fetchone()
+        return row
+
+    def push_events(self, events: list):
+        """
+        Queue membership events received by a follower for the leader to apply.
+        """
+        with closing(self._connect()) as db:
+            db.execute(
+                "INSERT INTO membership_events (events) VALUES (?)",
+                (json.dumps(events),),
+            )
+
+    def pop_events(self) -> list:
+        """
+        Remove and return all queued membership events, in the order they were received.
+        """
+        with closing(self._connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            rows = db.execute(
+                "SELECT events FROM membership_events ORDER BY id"
+            ).fetchall()
+            db.execute("DELETE FROM membership_events")
+            db.execute("COMMIT")
+        return [event for (events,) in rows for event in json.loads(events)]
@@ -0,0 +1,131 @@
+"""
+Snapshot of the user group index, to serve metrics right away after a restart.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+
+def encode_snapshot(
+    namespace: str, user_index: dict, slugs: dict, previous_etag: str = None
+) -> tuple[str, bytes | None]:
+    """
+    Encode the user index and username slugs as a gzipped JSON snapshot.
+
+    Returns the etag of the snapshot, and the snapshot itself unless it is unchanged since
+    the snapshot with previous_etag, in which case it is None.
+    """
+    content = json.dumps(
+        {"namespace": namespace, "user_index": user_index, "slugs": slugs},
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    etag = hashlib.sha256(content.encode()).hexdigest()
+    if etag == previous_etag:
+        return etag, None
+    header = json.dumps(
+        {"version": SNAPSHOT_VERSION, "etag": etag, "created": time.time()}
+    )
+    data = gzip.compress(f"{header}\n{content}".encode(), compresslevel=6, mtime=0)
+    return etag, data
+
+
+def decode_snapshot(data: bytes, namespace: str) -> dict | None:
+    """
+    Decode a snapshot made by encode_snapshot, or return None if it is unusable.
+
+    The returned dict has the etag and created time of the snapshot, the time of the last
+    crawl of the JupyterHub API that its user index comes from, which is the created time
+    unless the caller knows it, the user index as usernames to tuples of groups, and the
+    username slugs as usernames to tuples of the escaped and safe usernames.
+    """
+    try:
+        header, content = gzip.decompress(data).split(b"\n", 1)
+        header = json.loads(header)
+        if header["version"] != SNAPSHOT_VERSION:
+            logger.warning(
+                f"Ignoring snapshot with version {header['version']}, expected {SNAPSHOT_VERSION}."
+            )
+            return None
+        content = json.loads(content)
+    except (OSError, EOFError, ValueError, KeyError) as e:
+        logger.warning(f"Ignoring unreadable snapshot: {e!r}")
+        return None
+    if content["namespace"] != namespace:
+        logger.warning(
+            f"Ignoring snapshot of namespace {content['namespace']}, expected {namespace}."
+        )
+        return None
+    return {
+        "etag": header["etag"],
+        "created": header["created"],
+        "crawled": header["created"],
+        "user_index": {
+            user: tuple(groups) for user, groups in content["user_index"].items()
+        },
+        "slugs": {user: tuple(slugs) for user, slugs in content["slugs"].items()},
+    }
+
+
+def write_file_atomic(path: str, data: bytes):
+    """
+    Write data to a temporary file that then replaces the file at path, so a reader never
+    sees a partly written file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, path)
+
+
+def touch_snapshot(path: str, crawled: float):
+    """
+    Record the time of the last crawl of the JupyterHub API as the modification time of
+    the snapshot file at path, without rewriting it.
+    """
+    os.utime(path, (crawled, crawled))
+
+
+def write_snapshot(path: str, data: bytes, crawled: float):
+    """
+    Write a snapshot encoded by encode_snapshot to the file at path, with the time of the
+    last crawl of the JupyterHub API as its modification time.
+    """
+    write_file_atomic(path, data)
+    touch_snapshot(path, crawled)
+
+
+def load_snapshot(path: str, namespace: str) -> dict | None:
+    """
+    Load a snapshot written by write_snapshot, or return None if there is no usable
+    snapshot at path. The modification time of the file is the time of the last crawl.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+            crawled = os.fstat(f.fileno()).st_mtime
+    except FileNotFoundError:
+        logger.info(f"No snapshot found at {path}.")
+        return None
+    except OSError as e:
+        logger.warning(f"Ignoring unreadable snapshot {path}: {e!r}")
+        return None
+    snapshot = decode_snapshot(data, namespace)
+    if snapshot is not None:
+        snapshot["crawled"] = crawled
+    return snapshot
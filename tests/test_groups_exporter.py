@@ -1,8 +1,65 @@
+import asyncio
+import gzip
+import json
 import logging
+import re
+import time
 
 import aiohttp
+import pytest
+from aiohttp import web
+from prometheus_client import REGISTRY, CollectorRegistry, generate_latest
 from prometheus_client.parser import text_string_to_metric_families
 
+from jupyterhub_groups_exporter import app as exporter_app
+from jupyterhub_groups_exporter.debug import add_debug_routes
+from jupyterhub_groups_exporter.executor import make_executor, run_cpu_bound
+from jupyterhub_groups_exporter.exposition import (
+    FORMATS,
+    Exposition,
+    negotiate_encoding,
+    negotiate_format,
+)
+from jupyterhub_groups_exporter.groups_exporter import (
+    SLUG_CACHE,
+    SlugCache,
+    _escape_username,
+    _escape_username_safe,
+    apply_membership_events,
+    crawl_new_users,
+    current_update,
+    fetch_page,
+    group_usage_aggregates,
+    group_usage_samples,
+    iter_pages,
+    join_user_groups,
+    parse_membership_events,
+    prometheus_loads,
+    save_user_group_snapshot,
+    shard_query,
+    update_group_usage,
+    update_user_group_info,
+    user_group_info_samples,
+    username_shard_patterns,
+    username_slugs,
+)
+from jupyterhub_groups_exporter.metrics import (
+    CONFIG_DIRSIZE,
+    USER_LABELNAMES,
+    UserGroupGauge,
+    set_username_labels,
+)
+from jupyterhub_groups_exporter.resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryBudget,
+    UpstreamPolicy,
+)
+from jupyterhub_groups_exporter.scheduler import Scheduler, run_deadline
+from jupyterhub_groups_exporter.sessions import make_session
+from jupyterhub_groups_exporter.shared_state import SharedState
+from jupyterhub_groups_exporter.snapshot import decode_snapshot, load_snapshot
+
 logger = logging.getLogger(__name__)
 
 
@@ -47,3 +104,971 @@ async def test_groups_exporter_number(admin_request):
                 assert len(family.samples) == 52  # see tests/jupyterhub_config.py
     else:
         raise aiohttp.ClientError(f"Bad response: {response.status}")
+
+
+def test_join_user_groups():
+    """Test that users are joined with their allowed groups, 'none' and 'multiple'."""
+    user_index = {
+        "user-0": ("group-0", "group-1"),
+        "user-1": ("group-1",),
+        "user-2": (),
+        "user-3": ("group-2",),
+    }
+    user_to_groups, users_in_multiple_groups = join_user_groups(user_index, frozenset())
+    assert user_to_groups == {
+        "user-0": ["group-0", "group-1", "multiple"],
+        "user-1": ["group-1"],
+        "user-2": ["none"],
+        "user-3": ["group-2"],
+    }
+    assert users_in_multiple_groups == {"user-0"}
+    user_to_groups, users_in_multiple_groups = join_user_groups(
+        user_index, frozenset(["group-0", "group-2"])
+    )
+    assert user_to_groups["user-0"] == ["group-0", "group-1"]
+    assert user_to_groups["user-1"] == ["none"]
+    assert users_in_multiple_groups == set()
+
+
+def test_user_group_gauge():
+    """Test that setting the samples of a user group gauge replaces all of its series."""
+    gauge = UserGroupGauge(
+        "test", "Test gauge.", ["usergroup"], namespace="jupyterhub", registry=None
+    )
+    gauge.set_samples({("group-0",): 1, ("group-1",): 2})
+    gauge.set_samples({("group-1",): 3, ("group-2",): 4})
+    (family,) = gauge.collect()
+    samples = {s.labels["usergroup"]: s.value for s in family.samples}
+    assert family.name == "jupyterhub_test"
+    assert samples == {"group-1": 3, "group-2": 4}
+    assert len(gauge) == 2
+
+
+def test_user_group_gauge_reuses_labelvalues():
+    """Test that the label value tuples of unchanged series are reused across updates."""
+    gauge = UserGroupGauge(
+        "test", "Test gauge.", ["usergroup"], namespace="jupyterhub", registry=None
+    )
+    gauge.set_samples({("group-0",): 1, ("group-1",): 2})
+    previous = gauge._series.labelvalues
+    gauge.set_samples({("group-2",): 3, ("group-1",): 4})
+    labelvalues = gauge._series.labelvalues
+    assert labelvalues == (("group-2",), ("group-1",))
+    assert labelvalues[1] is previous[1]
+    assert list(gauge._series.values) == [3, 4]
+
+
+def test_slug_cache():
+    """Test that the slug cache counts hits and misses and evicts old usernames."""
+    cache = SlugCache(maxsize=2)
+    assert cache.get("User.0") == (
+        _escape_username("User.0"),
+        _escape_username_safe("User.0"),
+    )
+    cache.get("user-1")
+    cache.get("User.0")
+    cache.get("user-2")
+    assert (cache.hits, cache.misses) == (1, 3)
+    assert list(cache._slugs) == ["User.0", "user-2"]
+
+
+def test_group_usage_aggregates():
+    """Test that per-user usage is aggregated into per-group counts, sums and quantiles."""
+    samples = [
+        {
+            ("default", "group-0", "user-0", "user-2d0", "user-0"): 1.0,
+            ("default", "group-0", "user-1", "user-2d1", "user-1"): 3.0,
+            ("default", "group-1", "user-1", "user-2d1", "user-1"): 3.0,
+        }
+    ]
+    (aggregates,) = group_usage_aggregates(samples)
+    count, total, quantiles = aggregates[("default", "group-0")]
+    assert (count, total) == (2, 4.0)
+    assert dict(quantiles)[0.5] == 2.0
+    assert aggregates[("default", "group-1")] == (
+        1,
+        3.0,
+        ((0.5, 3.0), (0.9, 3.0), (0.99, 3.0)),
+    )
+
+
+async def test_upstream_session(aiohttp_server):
+    """Test that an upstream session reuses its connections and times out slow requests."""
+
+    async def slow(request):
+        await asyncio.sleep(float(request.query.get("delay", 0)))
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_get("/", slow)
+    server = await aiohttp_server(app)
+
+    def sample(name):
+        return REGISTRY.get_sample_value(name, {"upstream": "test"}) or 0
+
+    created = sample("jupyterhub_groups_exporter_http_connections_created_total")
+    reused = sample("jupyterhub_groups_exporter_http_connections_reused_total")
+    session = make_session(
+        "test",
+        connection_limit=1,
+        request_timeout=0.5,
+        connect_timeout=0.5,
+        keepalive_timeout=60,
+        dns_cache_ttl=10,
+    )
+    async with session:
+        for _ in range(3):
+            async with session.get(server.make_url("/")) as response:
+                await response.json()
+        with pytest.raises(asyncio.TimeoutError):
+            async with session.get(server.make_url("/"), params={"delay": 2}):
+                pass
+    assert (
+        sample("jupyterhub_groups_exporter_http_connections_created_total")
+        == created + 1
+    )
+    assert (
+        sample("jupyterhub_groups_exporter_http_connections_reused_total") == reused + 3
+    )
+
+
+async def test_upstream_policy():
+    """Test that retries are capped by the retry budget and the circuit breaker fails fast."""
+    attempts = []
+
+    async def flaky(failures):
+        attempts.append(None)
+        if len(attempts) <= failures:
+            raise aiohttp.ClientConnectionError("Connection refused.")
+        return "ok"
+
+    policy = UpstreamPolicy(
+        "test",
+        max_retries=3,
+        max_backoff=0,
+        budget=RetryBudget(ratio=0, min_retries=2),
+        breaker=CircuitBreaker(failure_threshold=3, reset_timeout=60),
+    )
+    assert await policy.call(lambda: flaky(2)) == "ok"
+    assert len(attempts) == 3
+    attempts.clear()
+    # The budget has no retries left, so the failure is raised straight away
+    with pytest.raises(aiohttp.ClientConnectionError):
+        await policy.call(lambda: flaky(1))
+    assert len(attempts) == 1
+    policy.breaker.record_failure()
+    policy.breaker.record_failure()
+    assert policy.breaker.is_open
+    with pytest.raises(CircuitOpenError):
+        await policy.call(lambda: flaky(0))
+    assert len(attempts) == 1
+
+
+async def test_upstream_policy_deadline():
+    """Test that attempts and backoff are capped so that retries fit in the cycle deadline."""
+    attempts = []
+
+    async def slow_then_fast():
+        attempts.append(None)
+        if len(attempts) == 1:
+            await asyncio.sleep(100)
+        return "ok"
+
+    policy = UpstreamPolicy("test", max_retries=3, max_backoff=30)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    token = run_deadline.set(start + 1)
+    try:
+        assert await policy.call(slow_then_fast) == "ok"
+    finally:
+        run_deadline.reset(token)
+    assert len(attempts) == 2
+    # The first attempt times out after half a second, and the backoff is at most 1/8s
+    assert loop.time() - start < 0.7
+
+
+async def test_fetch_page_metrics(aiohttp_server):
+    """Test that pages and bytes fetched are recorded under the current update."""
+
+    async def page(request):
+        return web.json_response({"items": []})
+
+    app = web.Application()
+    app.router.add_get("/", page)
+    server = await aiohttp_server(app)
+
+    def sample(name):
+        return REGISTRY.get_sample_value(name, {"update": "test"}) or 0
+
+    current_update.set("test")
+    async with aiohttp.ClientSession() as session:
+        for _ in range(2):
+            assert await fetch_page(session, server.make_url("/")) == {"items": []}
+    assert sample("jupyterhub_groups_exporter_update_pages_fetched_total") == 2
+    assert sample("jupyterhub_groups_exporter_update_bytes_downloaded_total") == 26
+
+
+async def test_fetch_page_error_status(aiohttp_server):
+    """Test that server errors are retried and other client errors are not."""
+    statuses = {"unavailable": [503, 503, 200], "forbidden": [403, 200]}
+    attempts = {path: 0 for path in statuses}
+
+    async def page(request):
+        path = request.match_info["path"]
+        status = statuses[path][attempts[path]]
+        attempts[path] += 1
+        return web.json_response({"items": [], "status": status}, status=status)
+
+    app = web.Application()
+    app.router.add_get("/{path}", page)
+    server = await aiohttp_server(app)
+    policy = UpstreamPolicy(
+        "test",
+        max_retries=3,
+        max_backoff=0,
+        breaker=CircuitBreaker(failure_threshold=3),
+    )
+    async with aiohttp.ClientSession() as session:
+        data = await fetch_page(
+            session, server.make_url("/"), "unavailable", policy=policy
+        )
+        assert data == {"items": [], "status": 200}
+        assert attempts["unavailable"] == 3
+        with pytest.raises(aiohttp.ClientResponseError) as e:
+            await fetch_page(session, server.make_url("/"), "forbidden", policy=policy)
+        assert e.value.status == 403
+        assert attempts["forbidden"] == 1
+        assert policy.breaker.failures == 0
+
+
+async def test_debug_endpoints(aiohttp_server):
+    """Test that the debug endpoints need the token, profile the exporter and dump its tasks."""
+    app = web.Application()
+    add_debug_routes(app, "secret")
+    server = await aiohttp_server(app)
+    async with aiohttp.ClientSession() as session:
+        async with session.get(server.make_url("/debug/tasks")) as response:
+            assert response.status == 403
+    async with aiohttp.ClientSession(
+        headers={"Authorization": "token secret"}
+    ) as session:
+        async with session.get(
+            server.make_url("/debug/profile"), params={"seconds": 1, "limit": 5}
+        ) as response:
+            assert response.status == 200
+            assert "function calls" in await response.text()
+        async with session.get(
+            server.make_url("/debug/stacks"), params={"seconds": 1, "limit": 5}
+        ) as response:
+            assert response.status == 200
+            stacks = (await response.text()).splitlines()
+            assert any(re.match(r"MainThread;.* \d+$", line) for line in stacks)
+        async with session.get(server.make_url("/debug/tasks")) as response:
+            assert "test_debug_endpoints" in await response.text()
+        async with session.get(
+            server.make_url("/debug/allocations"), params={"seconds": 0}
+        ) as response:
+            assert response.status == 400
+
+
+async def test_scheduler():
+    """Test that the scheduler spreads job phases and waits for runs going past a tick."""
+    starts = {"fast": [], "slow": []}
+
+    async def job(name, duration):
+        starts[name].append(asyncio.get_running_loop().time())
+        await asyncio.sleep(duration)
+
+    def skipped():
+        return (
+            REGISTRY.get_sample_value(
+                "jupyterhub_groups_exporter_update_cycles_skipped_total",
+                {"update": "slow"},
+            )
+            or 0
+        )
+
+    skipped_before = skipped()
+    scheduler = Scheduler()
+    scheduler.add_job("fast", 0.4, job, "fast", 0)
+    scheduler.add_job("slow", 0.4, job, "slow", 0.9)
+    scheduler.start()
+    await asyncio.sleep(1.5)
+    await scheduler.stop()
+    assert len(starts["fast"]) == 4
+    assert starts["slow"][0] - starts["fast"][0] == pytest.approx(0.2, abs=0.05)
+    # The tick at 0.6s waits for the first run to finish at 1.1s, and the tick at 1.0s
+    # that came in the meantime is skipped
+    assert len(starts["slow"]) == 2
+    assert starts["slow"][1] - starts["slow"][0] == pytest.approx(0.9, abs=0.05)
+    assert skipped() - skipped_before == 1
+    assert scheduler.jobs["slow"].run.cancelled()
+
+
+async def test_scheduler_deadline():
+    """Test that runs are cancelled before their next tick, which then starts on time."""
+    starts = []
+
+    async def job():
+        starts.append(asyncio.get_running_loop().time())
+        with pytest.raises(TimeoutError):
+            async with asyncio.timeout_at(run_deadline.get()):
+                await asyncio.sleep(100)
+
+    scheduler = Scheduler()
+    scheduler.add_job("stuck", 0.3, job)
+    scheduler.start()
+    await asyncio.sleep(1.0)
+    await scheduler.stop()
+    assert len(starts) == 4
+    for i, start in enumerate(starts):
+        assert start - starts[0] == pytest.approx(0.3 * i, abs=0.05)
+
+
+def test_apply_membership_events():
+    """Test that membership events are validated and applied to the user index in order."""
+    user_index = {"user-0": ("group-0",), "user-1": ("group-1",)}
+    events = parse_membership_events(
+        [
+            {"op": "add", "user": "user-0", "group": "group-1"},
+            {"op": "add", "user": "user-0", "group": "group-1"},
+            {"op": "remove", "user": "user-0", "group": "group-0"},
+            {"op": "delete", "user": "user-1"},
+            {"op": "set", "user": "user-2", "groups": ["group-2", "group-0"]},
+        ]
+    )
+    apply_membership_events(user_index, events)
+    assert user_index == {"user-0": ("group-1",), "user-2": ("group-2", "group-0")}
+    with pytest.raises(ValueError):
+        parse_membership_events({"op": "add", "user": "user-0"})
+
+
+async def test_save_user_group_snapshot(tmp_path):
+    """Test that snapshots round trip, are only rewritten when their content changes, and record the last crawl."""
+    path = str(tmp_path / "snapshot.json.gz")
+    state = SharedState(str(tmp_path / "state.sqlite"), lease_seconds=30)
+    app = {
+        "executor": None,
+        "namespace": "default",
+        "snapshot_path": path,
+        "shared_state": state,
+    }
+    user_index = {"user-0": ("group-0", "group-1"), "user-1": ()}
+    await save_user_group_snapshot(app, user_index, crawled=1000.0)
+    snapshot = load_snapshot(path, "default")
+    assert snapshot["etag"] == app["snapshot_etag"]
+    assert snapshot["user_index"] == user_index
+    assert snapshot["crawled"] == 1000.0
+    # An unchanged snapshot is not rewritten, but records the crawl
+    data = (tmp_path / "snapshot.json.gz").read_bytes()
+    await save_user_group_snapshot(app, user_index, crawled=2000.0)
+    assert (tmp_path / "snapshot.json.gz").read_bytes() == data
+    assert load_snapshot(path, "default")["crawled"] == 2000.0
+    assert state.fetch("user_index_crawled")[1] == b"2000.0"
+    # Membership events are saved, keeping the time of the crawl they were applied to
+    user_index = {"user-0": ("group-0",)}
+    await save_user_group_snapshot(app, user_index)
+    snapshot = load_snapshot(path, "default")
+    assert snapshot["user_index"] == user_index
+    assert snapshot["crawled"] == 2000.0
+    assert decode_snapshot(state.fetch("user_index")[1], "default") is not None
+    assert state.fetch("user_index_crawled")[1] == b"2000.0"
+    assert load_snapshot(path, "other") is None
+    assert load_snapshot(str(tmp_path / "missing.json.gz"), "default") is None
+
+
+def test_shared_state(tmp_path):
+    """Test that one replica holds the leader lease and the others read what it publishes."""
+    path = str(tmp_path / "state.db")
+    leader = SharedState(path, lease_seconds=30, identity="replica-0")
+    follower = SharedState(path, lease_seconds=30, identity="replica-1")
+    assert leader.acquire_lease()
+    assert not follower.acquire_lease()
+    assert leader.acquire_lease()
+    leader.publish("metrics", b"v1")
+    assert follower.fetch("metrics") == (1, b"v1")
+    assert follower.fetch("metrics", since_version=1) is None
+    leader.publish("metrics", b"v2")
+    assert follower.fetch("metrics", since_version=1) == (2, b"v2")
+    follower.push_events([{"op": "delete", "user": "user-0"}])
+    follower.push_events([{"op": "delete", "user": "user-1"}])
+    assert [event["user"] for event in leader.pop_events()] == ["user-0", "user-1"]
+    assert leader.pop_events() == []
+    leader.release_lease()
+    assert follower.acquire_lease()
+    assert not leader.acquire_lease()
+
+
+@pytest.mark.parametrize("shards", [1, 2, 5, 36, 100])
+def test_username_shard_patterns(shards):
+    """Test that every username is in exactly one shard."""
+    patterns = username_shard_patterns(shards)
+    assert len(patterns) == min(shards, 36)
+    for username in ["alice", "zoe", "0user", "9", "Bob", "-2duser", "élodie"]:
+        assert sum(bool(re.fullmatch(p, username)) for p in patterns) == 1
+    query = shard_query(CONFIG_DIRSIZE[0], patterns[0])
+    assert f'username_escaped=~"{patterns[0]}"' in query
+
+
+@pytest.mark.parametrize("usage_aggregation", ["last", "avg"])
+def test_prometheus_loads_orjson(usage_aggregation):
+    """Test that orjson decodes Prometheus responses to the same results as json."""
+    pytest.importorskip("orjson")
+    metric = {"namespace": "hub", "username": "user-0"}
+    body = json.dumps(
+        {
+            "status": "success",
+            "data": {
+                "result": [
+                    {"metric": metric, "value": [1.0, "2"]},
+                    {"metric": metric, "values": [[1.0, "1"], [2.0, "3"]]},
+                ]
+            },
+        }
+    )
+    data = prometheus_loads("orjson", usage_aggregation)(body)
+    assert data == prometheus_loads("json", usage_aggregation)(body)
+    assert data["data"]["result"][0] == ("user-0", 2.0)
+
+
+@pytest.mark.parametrize(
+    "accept, fmt",
+    [
+        ("", "text"),
+        ("text/plain;version=0.0.4;q=0.5,*/*;q=0.1", "text"),
+        (
+            "application/openmetrics-text;version=1.0.0,"
+            "text/plain;version=0.0.4;q=0.5,*/*;q=0.1",
+            "openmetrics",
+        ),
+        (
+            "application/openmetrics-text;version=1.0.0;q=0.5,"
+            "application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;"
+            "encoding=delimited;q=0.7",
+            "protobuf",
+        ),
+        ("application/vnd.google.protobuf;q=0.7,text/plain;q=0.5", "text"),
+        ("application/openmetrics-text;q=0", "text"),
+        ("application/openmetrics-text;q=0,*/*", "text"),
+        ("text/plain;q=0,application/openmetrics-text", "openmetrics"),
+        ("text/plain;q=0,*/*", "openmetrics"),
+        ("text/plain;q=0", "openmetrics"),
+        ("application/*;q=0.5,text/*;q=0.2", "openmetrics"),
+    ],
+)
+def test_negotiate_format(accept, fmt):
+    """Test that the format preferred by the scraper is served, falling back to text."""
+    assert negotiate_format(accept, list(FORMATS)) == fmt
+    assert negotiate_format(accept, ["text"]) == "text"
+
+
+def test_exposition():
+    """Test that each format and compression is rendered once per exposition."""
+    registry = CollectorRegistry()
+    gauge = UserGroupGauge(
+        "user_group_info",
+        "Test.",
+        ["namespace", "username"],
+        namespace="jupyterhub",
+        registry=registry,
+    )
+    gauge.set_samples({("hub", "user-0"): 1.0})
+    exposition = Exposition(registry)
+    # Formats rendered later still serve the metrics of the cycle of the exposition
+    gauge.set_samples({("hub", "user-1"): 1.0})
+    assert exposition.get("openmetrics", "gzip") is None
+    body = exposition.render("openmetrics", "gzip")
+    assert exposition.render("openmetrics", "gzip") is body
+    assert gzip.decompress(body).endswith(b"# EOF\n")
+    assert b"user-0" in gzip.decompress(body)
+    assert b"user-1" not in exposition.render("text", "identity")
+    assert negotiate_encoding("gzip, deflate") == "gzip"
+    assert negotiate_encoding("gzip;q=0") == "identity"
+    assert negotiate_encoding("gzip;q=0, *") != "gzip"
+    assert negotiate_encoding("zstd;q=0, gzip;q=0, *;q=0.5") == "identity"
+    assert negotiate_encoding("zstd;q=0, *;q=0.5") == "gzip"
+    # A single length-delimited MetricFamily with the name in field 1
+    body = exposition.render("protobuf", "identity")
+    assert body[0] == len(body) - 1
+    assert body[1:3] == bytes([0x0A, len("jupyterhub_user_group_info")])
+    assert b"user-0" in body
+
+
+def paginated_app(total: int, limit: int, fail_offset: int = None) -> web.Application:
+    """An app serving total items in pages of limit, failing the page at fail_offset."""
+    offsets = []
+
+    async def users(request):
+        offset = int(request.query.get("offset", 0))
+        offsets.append(offset)
+        if offset == fail_offset:
+            return web.Response(status=500, text="Internal Server Error")
+        await asyncio.sleep(0.05)
+        return web.json_response(
+            {
+                "items": [
+                    {"name": f"user-{i}"}
+                    for i in range(offset, min(offset + limit, total))
+                ],
+                "_pagination": {"offset": offset, "limit": limit, "total": total},
+            }
+        )
+
+    async def info(request):
+        return web.json_response({"version": "5.0.0"})
+
+    app = web.Application()
+    app["offsets"] = offsets
+    app.router.add_get("/users", users)
+    app.router.add_get("/info", info)
+    return app
+
+
+async def test_iter_pages(aiohttp_server):
+    """Test that every page is fetched by offset, and non-paginated data is passed through."""
+    server = await aiohttp_server(paginated_app(total=25, limit=10))
+    semaphore = asyncio.Semaphore(2)
+    async with aiohttp.ClientSession() as session:
+        pages = [
+            page
+            async for page in iter_pages(
+                session, server.make_url("/"), "users", semaphore
+            )
+        ]
+        assert sorted(len(page) for page in pages) == [5, 10, 10]
+        assert sorted(server.app["offsets"]) == [0, 10, 20]
+        pages = [
+            page
+            async for page in iter_pages(
+                session, server.make_url("/"), "info", semaphore
+            )
+        ]
+        assert pages == [{"version": "5.0.0"}]
+
+
+async def test_iter_pages_cancels_on_error(aiohttp_server):
+    """Test that the remaining pages are not fetched once a page has failed."""
+    server = await aiohttp_server(paginated_app(total=100, limit=10, fail_offset=10))
+    semaphore = asyncio.Semaphore(1)
+    async with aiohttp.ClientSession() as session:
+        with pytest.raises(aiohttp.ClientError):
+            async for _ in iter_pages(
+                session, server.make_url("/"), "users", semaphore
+            ):
+                pass
+        await asyncio.sleep(0.3)
+    assert len(server.app["offsets"]) <= 3
+
+
+async def test_crawl_new_users_after_deletions(aiohttp_server):
+    """Test that new users are found when deleted users shift them before the last total."""
+    known = [f"user-{i}" for i in range(10)]
+    # Three users deleted and three created since the last crawl, which saw 10 users
+    hub_users = known[3:] + [f"user-{i}" for i in range(10, 13)]
+
+    async def users(request):
+        offset = int(request.query.get("offset", 0))
+        limit = min(int(request.query.get("limit", 4)), 4)
+        return web.json_response(
+            {
+                "items": [{"name": u} for u in hub_users[offset : offset + limit]],
+                "_pagination": {
+                    "offset": offset,
+                    "limit": limit,
+                    "total": len(hub_users),
+                },
+            }
+        )
+
+    app = web.Application()
+    app.router.add_get("/hub/api/users", users)
+    server = await aiohttp_server(app)
+    folded = set()
+    async with aiohttp.ClientSession() as session:
+        total = await crawl_new_users(
+            session,
+            server.make_url("/"),
+            asyncio.Semaphore(2),
+            frozenset(known),
+            10,
+            lambda items: folded.update(r["name"] for r in items),
+        )
+    assert total == 10
+    assert {"user-10", "user-11", "user-12"} <= folded
+
+
+async def test_process_executor_slug_cache():
+    """Test that usernames are escaped with the slug cache of the main process when CPU-bound work runs in a process pool."""
+    user_index = {"alice.one": ("group-a",), "bob": ("group-a", "group-b")}
+    labelnames = ("namespace", "usergroup", "username", "username_escaped")
+    with make_executor("process") as executor:
+        app = {"executor_kind": "process", "executor": executor}
+        slugs = await username_slugs(app, user_index)
+        assert "alice.one" in SLUG_CACHE.dump()
+        _, samples = await run_cpu_bound(
+            app,
+            user_group_info_samples,
+            user_index,
+            frozenset(),
+            "hub",
+            True,
+            labelnames,
+            slugs,
+        )
+        assert ("hub", "group-a", "alice.one", "alice-2eone") in samples
+        results = [[("bob", 2.0)]]
+        slugs = await username_slugs(app, {"bob"})
+        [usage] = await run_cpu_bound(
+            app,
+            group_usage_samples,
+            results,
+            {"bob": ["group-a", "group-b"]},
+            "hub",
+            [labelnames],
+            slugs,
+        )
+        assert usage == {
+            ("hub", "group-a", "bob", "bob"): 2.0,
+            ("hub", "group-b", "bob", "bob"): 2.0,
+        }
+    assert await username_slugs({"executor_kind": "thread"}, user_index) is None
+
+
+def test_username_label_projection():
+    """Test that gauges restricted to some username labels export only those labels."""
+    registry = CollectorRegistry()
+    info = UserGroupGauge(
+        "test_info", "Test.", USER_LABELNAMES, namespace="jupyterhub", registry=registry
+    )
+    usage = UserGroupGauge(
+        "test_usage",
+        "Test.",
+        USER_LABELNAMES,
+        namespace="jupyterhub",
+        registry=registry,
+    )
+    set_username_labels(info, ["username_escaped"])
+    set_username_labels(usage, ["username", "username_safe"])
+    _, samples = user_group_info_samples(
+        {"alice.one": ("group-a",)}, frozenset(), "hub", True, info.labelnames
+    )
+    assert samples == {("hub", "group-a", "alice-2eone"): 1}
+    info.set_samples(samples)
+    [usage_samples] = group_usage_samples(
+        [[("alice.one", 2.0)]], {"alice.one": ["group-a"]}, "hub", [usage.labelnames]
+    )
+    assert usage_samples == {
+        ("hub", "group-a", "alice.one", _escape_username_safe("alice.one")): 2.0
+    }
+    usage.set_samples(usage_samples)
+    text = generate_latest(registry).decode()
+    assert (
+        'jupyterhub_test_info{namespace="hub",usergroup="group-a",username_escaped="alice-2eone"} 1.0'
+        in text
+    )
+    assert (
+        'jupyterhub_test_usage{namespace="hub",usergroup="group-a",username="alice.one",username_safe='
+        in text
+    )
+    with pytest.raises(RuntimeError):
+        set_username_labels(info, ["username"])
+
+
+async def test_queue_membership_events(monkeypatch):
+    """Test that membership events posted in a burst are applied in one batch."""
+    batches = []
+
+    async def apply_events(app, events):
+        batches.append(events)
+
+    monkeypatch.setattr(exporter_app, "apply_events", apply_events)
+    app = {"pending_membership_events": [], "membership_events_delay": 0.05}
+    for i in range(3):
+        exporter_app.queue_events(app, [{"op": "delete", "user": f"user-{i}"}])
+        await asyncio.sleep(0.01)
+    await app["membership_events_task"]
+    exporter_app.queue_events(app, [{"op": "delete", "user": "user-3"}])
+    await app["membership_events_task"]
+    assert [[event["user"] for event in events] for events in batches] == [
+        ["user-0", "user-1", "user-2"],
+        ["user-3"],
+    ]
+
+
+async def test_load_user_group_snapshot_phase():
+    """Test that the first crawl after loading a snapshot is due one interval after the last crawl."""
+    app = {
+        "user_group_lock": asyncio.Lock(),
+        "executor": None,
+        "executor_kind": "none",
+        "allowed_groups": [],
+        "namespace": "default",
+        "double_count": True,
+        "update_info_interval": 3600,
+    }
+    snapshot = {
+        "etag": "etag",
+        # Memberships unchanged for a day, but crawled 10 minutes ago
+        "created": time.time() - 86400,
+        "crawled": time.time() - 600,
+        "user_index": {"user-0": ("group-0",)},
+        "slugs": {},
+    }
+    phase = await exporter_app.load_user_group_snapshot(app, snapshot)
+    assert 2990 < phase <= 3000
+    assert app["user_group_map"] == {"user-0": ["group-0"]}
+    snapshot["crawled"] = snapshot["created"]
+    assert await exporter_app.load_user_group_snapshot(app, snapshot) == 0
+
+
+def paginate(request: web.Request, items: list, max_limit: int = 2) -> web.Response:
+    """Respond with a page of items, like the paginated JupyterHub API."""
+    offset = int(request.query.get("offset", 0))
+    limit = min(int(request.query.get("limit", max_limit)), max_limit)
+    return web.json_response(
+        {
+            "items": items[offset : offset + limit],
+            "_pagination": {"offset": offset, "limit": limit, "total": len(items)},
+        }
+    )
+
+
+async def test_update_user_group_info_incremental(aiohttp_server):
+    """Test full resyncs and incremental updates of user group memberships."""
+    # Users in order of creation, with their groups
+    hub = {"user-0": ["group-0"], "user-1": ["group-1"], "user-2": ["group-0"]}
+    events = []
+
+    async def users(request):
+        items = [{"name": u, "groups": groups} for u, groups in hub.items()]
+        return paginate(request, items)
+
+    async def groups(request):
+        # An event posted while the crawl is running
+        exporter["membership_events"].extend(events)
+        names = sorted({group for groups in hub.values() for group in groups})
+        items = [
+            {"name": g, "users": [u for u, groups in hub.items() if g in groups]}
+            for g in names
+        ]
+        return paginate(request, items)
+
+    hub_app = web.Application()
+    hub_app.router.add_get("/hub/api/users", users)
+    hub_app.router.add_get("/hub/api/groups", groups)
+    server = await aiohttp_server(hub_app)
+    async with aiohttp.ClientSession() as session:
+        exporter = {
+            "hub_session": session,
+            "hub_url": server.make_url("/"),
+            "hub_api_concurrency": 2,
+            "hub_policy": None,
+            "json_decoder": "json",
+            "allowed_groups": [],
+            "full_resync_cycles": 2,
+            "membership_events": [],
+            "user_group_lock": asyncio.Lock(),
+            "executor": None,
+            "executor_kind": "none",
+            "namespace": "default",
+            "double_count": True,
+            "snapshot_path": None,
+            "shared_state": None,
+        }
+        assert await update_user_group_info(exporter) == 3
+        assert exporter["user_index"] == {
+            "user-0": ("group-0",),
+            "user-1": ("group-1",),
+            "user-2": ("group-0",),
+        }
+        assert exporter["hub_users_total"] == 3
+
+        # A user added, a user moved, a user deleted, and an event during the crawl
+        del hub["user-0"]
+        hub["user-1"] = ["group-0"]
+        hub["user-3"] = ["group-1"]
+        events.append({"op": "add", "user": "user-2", "group": "group-2"})
+        await update_user_group_info(exporter)
+        # Deleted users are kept, with no groups, until the next full resync
+        assert exporter["user_index"] == {
+            "user-0": (),
+            "user-1": ("group-0",),
+            "user-2": ("group-0", "group-2"),
+            "user-3": ("group-1",),
+        }
+        assert exporter["user_group_map"]["user-0"] == ["none"]
+        assert exporter["hub_users_total"] == 3
+        assert exporter["membership_events"] == []
+
+        events.clear()
+        await update_user_group_info(exporter)
+        assert exporter["user_index"] == {
+            "user-1": ("group-0",),
+            "user-2": ("group-0",),
+            "user-3": ("group-1",),
+        }
+        assert exporter["user_group_cycle"] == 3
+
+
+@pytest.mark.parametrize("usage_aggregation", ["last", "avg"])
+async def test_update_group_usage(aiohttp_server, usage_aggregation):
+    """Test that sharded usage queries are merged, keeping previous values of failed metrics."""
+    usage = {"alice": 2.0, "zed": 4.0}
+    requests = []
+
+    async def query(request):
+        requests.append((request.path, dict(request.query)))
+        promql = request.query["query"]
+        pattern = re.search(r'username=~"([^"]*)"', promql).group(1)
+        if promql.startswith("cpu") and pattern.startswith("[^"):
+            return web.json_response({"status": "error"}, status=503)
+        result = []
+        for username, value in usage.items():
+            if re.fullmatch(pattern, username):
+                sample = {"metric": {"username": username}}
+                if request.path.endswith("query_range"):
+                    sample["values"] = [[0, str(value - 1)], [1, str(value + 1)]]
+                else:
+                    sample["value"] = [0, str(value)]
+                result.append(sample)
+        return web.json_response(
+            {"status": "success", "data": {"resultType": "vector", "result": result}}
+        )
+
+    prometheus = web.Application()
+    prometheus.router.add_get("/api/v1/query", query)
+    prometheus.router.add_get("/api/v1/query_range", query)
+    server = await aiohttp_server(prometheus)
+    labelnames = ("namespace", "usergroup", "username")
+    memory = UserGroupGauge("test_memory", "Test.", labelnames, "test", None)
+    cpu = UserGroupGauge("test_cpu", "Test.", labelnames, "test", None)
+    cpu.set_samples({("default", "group-0", "alice"): 1.0})
+    queries = [
+        {
+            "name": name,
+            "query": f'{name}{{username=~".*", namespace=~".*"}}',
+            "shard_label": "username",
+            "metric": metric,
+        }
+        for name, metric in [("memory", memory), ("cpu", cpu)]
+    ]
+    async with aiohttp.ClientSession() as session:
+        app = {
+            "user_group_map": {"alice": ["group-0"], "zed": ["group-1", "group-2"]},
+            "prometheus_session": session,
+            "prometheus_policy": None,
+            "prometheus_host": server.host,
+            "prometheus_port": server.port,
+            "namespace": "default",
+            "usage_aggregation": usage_aggregation,
+            "update_metrics_interval": 15,
+            "json_decoder": "json",
+            "query_shards": 2,
+            "group_aggregates": False,
+            "per_user_series": True,
+            "executor": None,
+            "executor_kind": "none",
+        }
+        config = {"queries": queries, "update_interval": 15}
+        assert await update_group_usage(app, config) == 3
+    # Every query is sent once per shard, restricted to the users of the shard
+    assert len(requests) == 4
+    patterns = {
+        re.search(r'username=~"([^"]*)"', q["query"]).group(1) for _, q in requests
+    }
+    assert patterns == set(username_shard_patterns(2))
+    for path, params in requests:
+        assert 'namespace="default"' in params["query"]
+        if usage_aggregation == "last":
+            assert path == "/api/v1/query"
+            assert set(params) == {"query", "time"}
+        else:
+            assert path == "/api/v1/query_range"
+            assert set(params) == {"query", "start", "end", "step"}
+            assert params["step"] == "15s"
+    (family,) = memory.collect()
+    assert {tuple(s.labels.values()): s.value for s in family.samples} == {
+        ("default", "group-0", "alice"): 2.0,
+        ("default", "group-1", "zed"): 4.0,
+        ("default", "group-2", "zed"): 4.0,
+    }
+    # The cpu query failed in one shard, so its previous values are kept
+    (family,) = cpu.collect()
+    assert {tuple(s.labels.values()): s.value for s in family.samples} == {
+        ("default", "group-0", "alice"): 1.0
+    }
+
+
+async def test_membership_events_endpoint(aiohttp_server, tmp_path):
+    """Test that a follower checks, validates and queues posted membership events for the leader."""
+    path = str(tmp_path / "state.sqlite")
+    leader = SharedState(path, lease_seconds=30, identity="replica-0")
+    assert leader.acquire_lease()
+    app = exporter_app.sub_app(
+        hub_url="http://127.0.0.1:1",
+        update_info_interval=3600,
+        update_metrics_interval=3600,
+        hub_connection_limit=1,
+        prometheus_connection_limit=1,
+        hub_request_timeout=1,
+        prometheus_request_timeout=1,
+        connect_timeout=1,
+        keepalive_timeout=1,
+        dns_cache_ttl=1,
+        max_retries=0,
+        retry_budget_ratio=0.2,
+        circuit_breaker_failures=5,
+        circuit_breaker_reset_timeout=30,
+        executor="none",
+        slug_cache_size=100,
+        membership_events_token="secret",
+        membership_events_delay=0,
+        shared_state_path=path,
+        leader_lease_seconds=30,
+    )
+    server = await aiohttp_server(app)
+    url = server.make_url("/membership-events")
+    events = [
+        {"op": "add", "user": "user-0", "group": "group-0"},
+        {"op": "delete", "user": "user-1"},
+    ]
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=events) as response:
+            assert response.status == 403
+        async with session.post(
+            url, json=events, headers={"Authorization": "token wrong"}
+        ) as response:
+            assert response.status == 403
+    async with aiohttp.ClientSession(
+        headers={"Authorization": "token secret"}
+    ) as session:
+        async with session.post(url, data="[{") as response:
+            assert response.status == 400
+        async with session.post(
+            url, json=[{"op": "add", "user": "user-0"}]
+        ) as response:
+            assert response.status == 400
+            assert "must have a group" in await response.text()
+        async with session.post(url, json=events) as response:
+            assert response.status == 202
+            assert await response.json() == {"events": 2}
+    assert not app["shared_state"].is_leader
+    assert app["pending_membership_events"] == []
+    assert leader.pop_events() == events
+    # Clean up the replica while the event loop still runs
+    await server.close()
+
+
+def test_render_metrics():
+    """Test that the formats Prometheus and earlier scrapers negotiated are rendered with each cycle."""
+    app = {"exposition": {"negotiated": {("protobuf", "identity")}}}
+    exporter_app.render_metrics(app)
+    exposition = app["exposition"]["payload"]
+    for fmt, encoding in [
+        ("text", "gzip"),
+        ("openmetrics", "gzip"),
+        ("protobuf", "identity"),
+    ]:
+        assert exposition.get(fmt, encoding) is not None
+    assert exposition.get("openmetrics", "identity") is not None
+    assert exposition.get("protobuf", "gzip") is None